@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+本地的JDDBXML server替身, 回應 /jddbxml/gethistdata.aspx, 讓KDataSvc/server.py可以在沒有網路的環境下做load test.
+
+資料來源:
+- 預設: 每個股號以pp.synthetic產生 (seed由股號決定, 同一個股號每次都一樣), 從--start到今天
+- --record-dir: 錄下來的回傳內容, 檔名是<SID>.xml (沒有檔案的股號回傳404)
+
+    $ python bench/fake_jddb.py --port 7000 --latency 50 --jitter 20 --error-rate 0.01
+    $ JDDB_HOST=localhost:7000 python server.py
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import zlib
+import random
+import argparse
+import threading
+from datetime import date
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import numpy as np
+from pp import kdata, synthetic
+
+
+class Source(object):
+    """
+    每個股號的完整K線資料 (第一次查詢時產生/讀取, 之後留在記憶體)
+    """
+    def __init__(self, record_dir=None, start='2000-01-03'):
+        self.record_dir = record_dir
+        self.start = start
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, symbol):
+        """
+        :return: KData, 沒有這個股號時回傳None
+        """
+        with self._lock:
+            if symbol not in self._data:
+                self._data[symbol] = self._load(symbol)
+            return self._data[symbol]
+
+    def _load(self, symbol):
+        if self.record_dir:
+            path = os.path.join(self.record_dir, os.path.basename(symbol) + '.xml')
+            if not os.path.exists(path):
+                return None
+            with open(path, 'rb') as f:
+                return kdata.parse(f.read())
+        n = int(np.busday_count(np.datetime64(self.start, 'D'), np.datetime64(date.today(), 'D'))) + 1
+        return synthetic.make_kdata(n, seed=zlib.crc32(symbol.encode('utf-8')), start=self.start)
+
+
+class Handler(BaseHTTPRequestHandler):
+    # 由make_server設定
+    source = None
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.lower() != '/jddbxml/gethistdata.aspx':
+            return self._send(404, b'not found')
+        query = dict((k.lower(), v[0]) for k, v in parse_qs(url.query).items())
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < self.error_rate:
+            return self._send(500, b'injected error')
+        try:
+            symbol, start, end = query['sid'], int(query['b']), int(query['d'])
+        except (KeyError, ValueError):
+            return self._send(400, b'bad request')
+        kd = self.source.get(symbol)
+        if kd is None:
+            return self._send(404, b'unknown symbol')
+        self._send(200, synthetic.to_jddbxml(kd.slice(start, end)), 'text/xml; charset=utf-8')
+
+    def _send(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(host='localhost', port=0, record_dir=None, latency=0.0, jitter=0.0, error_rate=0.0,
+                start='2000-01-03'):
+    """
+    建立fake server (還沒有開始serve)
+    :param latency: 每個request的延遲(秒)
+    :param jitter: 延遲的變動範圍(秒), 實際延遲是latency +- jitter
+    :param error_rate: 回傳500的比例
+    :return: ThreadingHTTPServer, server.server_address是實際的(host, port)
+    """
+    handler = type('FakeJDDBHandler', (Handler,), {
+        'source': Source(record_dir, start),
+        'latency': latency,
+        'jitter': jitter,
+        'error_rate': error_rate,
+    })
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def start(**kwargs):
+    """
+    在背景thread啟動fake server (參數同make_server)
+    :return: "host:port", 可以直接傳給KDataSvc
+    """
+    server = make_server(**kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return '%s:%d' % server.server_address[:2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fake JDDBXML server for offline load tests')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=7000)
+    parser.add_argument('--record-dir', help='folder of recorded responses named <SID>.xml')
+    parser.add_argument('--start', default='2000-01-03', help='first date of the synthetic data')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds')
+    parser.add_argument('--jitter', type=float, default=0, help='milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests answered with 500')
+    args = parser.parse_args(argv)
+
+    server = make_server(args.host, args.port, args.record_dir, args.latency / 1000.0, args.jitter / 1000.0,
+                         args.error_rate, args.start)
+    print('fake JDDBXML server on %s:%d' % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
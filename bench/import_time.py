@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+檢查計算用的module的import時間, 以及不會載入畫圖/網路相關的套件 (matplotlib, requests, bs4)
+
+每個module在新的python process裡面以 -X importtime 量測, 超過budget或是載入了不該載入的套件時exit code = 1
+
+    $ python bench/import_time.py
+    $ python bench/import_time.py --budget 0.5 --repeat 5
+"""
+from __future__ import print_function
+import os
+import re
+import sys
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 只做計算的module
+MODULES = ('pp.kdata', 'pp.zigzag', 'pp.rdp', 'pp.patternfinder', 'pp.patternspec', 'pp.panel', 'pp.scanner',
+           'pp.downsample', 'pp.memo', 'pp.fractal')
+
+# import上面那些module時不應該出現的套件
+FORBIDDEN = ('matplotlib', 'requests', 'bs4', 'urllib3')
+
+
+def measure(module):
+    """
+    :return: (import時間(秒), 載入的FORBIDDEN套件)
+    """
+    code = 'import sys, %s; print(",".join(m for m in %r if m in sys.modules))' % (module, FORBIDDEN)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    # -X importtime的格式: "import time: self [us] | cumulative | imported package"
+    total = 0
+    for line in proc.stderr.splitlines():
+        m = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\S+)$', line)
+        if m:
+            total += int(m.group(1))
+    loaded = [m for m in proc.stdout.strip().split(',') if m]
+    return total / 1e6, loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Guard the import time of the compute modules')
+    parser.add_argument('--budget', type=float, default=0.4, help='max import time (seconds) of each module')
+    parser.add_argument('--repeat', type=int, default=3, help='take the best of N runs')
+    args = parser.parse_args(argv)
+
+    failed = False
+    for module in MODULES:
+        results = [measure(module) for _ in range(args.repeat)]
+        seconds = min(t for t, _ in results)
+        loaded = results[0][1]
+        status = 'ok'
+        if loaded:
+            status = 'FAIL: loaded ' + ','.join(loaded)
+        elif seconds > args.budget:
+            status = 'FAIL: over budget (%.3fs)' % args.budget
+        failed = failed or status != 'ok'
+        print('%-18s %8.3fs  %s' % (module, seconds, status))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
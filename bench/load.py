@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+server.py的load generator: 以固定的concurrency對/api/zigzag與/api/rdp送request,
+報告每個endpoint的p50/p95/p99 latency與throughput.
+
+    $ python bench/fake_jddb.py --port 7000 --latency 50 &
+    $ JDDB_HOST=localhost:7000 SERVER_MODE=prefork python server.py &
+    $ python bench/load.py --url http://localhost:6060 --concurrency 32 --duration 30
+
+--unique讓每個request的參數都不一樣 (不會命中server的圖形快取), 用來量測實際的計算成本.
+"""
+from __future__ import print_function
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import requests
+import numpy as np
+
+ENDPOINTS = ('zigzag', 'rdp')
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {'p50': p50, 'p95': p95, 'p99': p99, 'max': max(latencies)}
+
+
+class Stats(object):
+    def __init__(self):
+        self.latencies = dict((endpoint, []) for endpoint in ENDPOINTS)
+        self.status = dict((endpoint, {}) for endpoint in ENDPOINTS)
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, seconds, status):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            self.status[endpoint][status] = self.status[endpoint].get(status, 0) + 1
+
+
+def worker(args, stats, deadline, counter):
+    session = requests.Session()
+    rs = random.Random()
+    while time.time() < deadline:
+        with counter['lock']:
+            if args.requests and counter['sent'] >= args.requests:
+                return
+            counter['sent'] += 1
+            serial = counter['sent']
+        endpoint = rs.choice(args.endpoints)
+        params = {'id': rs.choice(args.symbols), 'eps': rs.choice(args.eps)}
+        if args.start:
+            params['start'] = args.start
+        if args.end:
+            params['end'] = args.end
+        if args.unique:
+            # 每個request的圖形大小都不一樣, 不會命中快取
+            params['w'] = '%.4f' % (8 + serial * 1e-4)
+        started = time.time()
+        try:
+            res = session.get('%s/api/%s' % (args.url, endpoint), params=params, timeout=args.timeout)
+            res.content
+            status = res.status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        stats.add(endpoint, time.time() - started, status)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test /api/zigzag and /api/rdp')
+    parser.add_argument('--url', default='http://localhost:6060')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--requests', type=int, default=0, help='stop after N requests (0: until --duration)')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--symbols', default='2330.TW,2317.TW,2454.TW,2412.TW,1301.TW',
+                        help='comma separated symbols, or N for S0000..S<N-1>')
+    parser.add_argument('--eps', default='3,5,8')
+    parser.add_argument('--start', help='yyyymmdd')
+    parser.add_argument('--end', help='yyyymmdd')
+    parser.add_argument('--unique', action='store_true', help='bypass the server render cache')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    args.endpoints = [e for e in args.endpoints.split(',') if e]
+    for endpoint in args.endpoints:
+        if endpoint not in ENDPOINTS:
+            parser.error('unknown endpoint: %s' % endpoint)
+    if args.symbols.isdigit():
+        args.symbols = ['S%04d' % i for i in range(int(args.symbols))]
+    else:
+        args.symbols = [s for s in args.symbols.split(',') if s]
+    args.eps = [e for e in args.eps.split(',') if e]
+
+    stats = Stats()
+    counter = {'sent': 0, 'lock': threading.Lock()}
+    started = time.time()
+    deadline = started + args.duration
+    threads = [threading.Thread(target=worker, args=(args, stats, deadline, counter))
+               for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - started
+
+    report = {'concurrency': args.concurrency, 'elapsed': elapsed, 'endpoints': {}}
+    total = 0
+    for endpoint in args.endpoints:
+        latencies = stats.latencies[endpoint]
+        total += len(latencies)
+        ok = stats.status[endpoint].get(200, 0) + stats.status[endpoint].get(304, 0)
+        report['endpoints'][endpoint] = dict(percentiles(latencies), requests=len(latencies),
+                                             throughput=len(latencies) / elapsed, ok=ok,
+                                             status=dict((str(k), v) for k, v in stats.status[endpoint].items()))
+    report['throughput'] = total / elapsed
+
+    if args.json:
+        print(json.dumps(report, indent=1, sort_keys=True))
+        return 0
+    print('concurrency %d, %.1fs, %.1f req/s' % (args.concurrency, elapsed, report['throughput']))
+    for endpoint, r in sorted(report['endpoints'].items()):
+        if not r['requests']:
+            continue
+        print('%-8s %6d req %8.1f req/s  p50 %7.1fms  p95 %7.1fms  p99 %7.1fms  max %7.1fms  status %s' % (
+            endpoint, r['requests'], r['throughput'], r['p50'] * 1000, r['p95'] * 1000, r['p99'] * 1000,
+            r['max'] * 1000, r['status']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite: 以pp.synthetic產生的資料量測所有主要的計算路徑, 不需要連線
+
+    $ python bench/run.py                                   # 1k/10k/100k bars
+    $ python bench/run.py --full --save bench/baseline.json # 1k ~ 10M bars, 存成baseline
+    $ python bench/run.py --compare bench/baseline.json     # 跟baseline比較, 變慢超過threshold時exit code = 1
+    $ python bench/run.py --filter 'find_|parse' --payloads recorded/   # 只跑部分case, 另外解析錄下來的回傳內容
+
+結果(JSON)的格式:
+    {"meta": {...}, "results": {"<case>@<size>": {"min": 秒, "median": 秒, "runs": 次數}}}
+"""
+from __future__ import print_function
+import io
+import os
+import re
+import sys
+import glob
+import json
+import time
+import platform
+import argparse
+import warnings
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from pp import kdata, zigzag, rdp, fractal, synthetic
+from pp.patternfinder import Finder
+
+THRESH = 0.03
+EPSILON = 3
+
+# (name, function(fixture), 最多幾根K棒 (超過就跳過, None表示不限制))
+CASES = []
+# (name, function(universe fixture))
+UNIVERSE_CASES = []
+
+
+def case(name, max_bars=None):
+    def register(fn):
+        CASES.append((name, fn, max_bars))
+        return fn
+    return register
+
+
+def universe_case(name):
+    def register(fn):
+        UNIVERSE_CASES.append((name, fn))
+        return fn
+    return register
+
+
+class Fixture(object):
+    """
+    一個size的測試資料, 需要時才產生
+    """
+    def __init__(self, n, seed):
+        self.n = n
+        self.seed = seed
+        self._cache = {}
+
+    def _get(self, name, make):
+        if name not in self._cache:
+            self._cache[name] = make()
+        return self._cache[name]
+
+    @property
+    def kd(self):
+        return self._get('kd', lambda: synthetic.make_kdata(self.n, seed=self.seed))
+
+    @property
+    def X(self):
+        return self.kd.close
+
+    @property
+    def pivots(self):
+        return self._get('pivots', lambda: zigzag.peak_valley_pivots(self.X, THRESH, -THRESH))
+
+    @property
+    def finder(self):
+        def make():
+            finder = Finder(self.kd)
+            finder.init_pivots(THRESH)
+            return finder
+        return self._get('finder', make)
+
+    @property
+    def scaled(self):
+        # 跟RDP一樣scale到0~100
+        def make():
+            low, high = self.X.min(), self.X.max()
+            return (self.X - low) * 100.0 / max(high - low, 1)
+        return self._get('scaled', make)
+
+    @property
+    def payload(self):
+        return self._get('payload', lambda: synthetic.to_jddbxml(self.kd))
+
+
+class UniverseFixture(object):
+    def __init__(self, symbols, n, seed):
+        self.symbols = symbols
+        self.n = n
+        universe = synthetic.make_universe(symbols, n, seed=seed)
+        # 依日期對齊 (上市前是nan), 跟Panel一樣的排列方式
+        self.X = np.full((symbols, n), np.nan)
+        for i, kd in enumerate(universe.values()):
+            self.X[i, n - len(kd):] = kd.close
+        self.series = [kd.close for kd in universe.values()]
+
+
+# ---- zigzag ----
+
+@case('zigzag.peak_valley_pivots')
+def _pivots(f):
+    zigzag.pivot_memo.clear()
+    zigzag.peak_valley_pivots(f.X, THRESH, -THRESH)
+
+
+@case('zigzag.peak_valley_pivots[memo]')
+def _pivots_memo(f):
+    zigzag.peak_valley_pivots(f.X, THRESH, -THRESH)
+
+
+@case('zigzag.PivotHierarchy', max_bars=1000000)
+def _hierarchy(f):
+    zigzag.pivot_memo.clear()
+    zigzag.PivotHierarchy(f.X, 0.01).pivots(THRESH)
+
+
+@case('zigzag.max_drawdown')
+def _max_drawdown(f):
+    zigzag.max_drawdown(f.X)
+
+
+@case('zigzag.pivots_to_modes')
+def _modes(f):
+    zigzag.pivots_to_modes(f.pivots)
+
+
+# ---- fractal ----
+
+@case('fractal.fractal_points')
+def _fractal(f):
+    fractal.fractal_points(f.kd.high, f.kd.low, 5)
+
+
+# ---- Finder ----
+
+@case('finder.init_pivots')
+def _init_pivots(f):
+    zigzag.pivot_memo.clear()
+    Finder(f.kd).init_pivots(THRESH)
+
+
+@case('finder.find_all')
+def _find_all(f):
+    f.finder.find_all()
+
+
+for _name in ('hs', 'ihs', 'double_top', 'double_bottom', 'triple_top', 'triple_bottom'):
+    case('finder.find_' + _name)(lambda f, _name=_name: getattr(f.finder, 'find_' + _name)())
+
+
+# ---- RDP ----
+
+@case('rdp.rdp')
+def _rdp(f):
+    rdp.rdp(f.scaled, EPSILON)
+
+
+@case('rdp.RDP[ranked]')
+def _rdp_ranked(f):
+    rdp.significance_memo.clear()
+    rdp.RDP(f.kd, EPSILON, ranked=True)
+
+
+# ---- JDDBXML parsing ----
+
+@case('parse.iterparse', max_bars=1000000)
+def _parse_iterparse(f):
+    kdata.parse_iterparse(io.BytesIO(f.payload))
+
+
+@case('parse.bs4', max_bars=100000)
+def _parse_bs4(f):
+    kdata.parse_bs4(io.BytesIO(f.payload))
+
+
+# ---- plotting (render成png, 不開視窗) ----
+
+@case('plot.zigzag', max_bars=1000000)
+def _plot_zigzag(f):
+    zigzag.plot_zigzag(f.kd, f.pivots, filename=io.BytesIO())
+
+
+@case('plot.rdp', max_bars=1000000)
+def _plot_rdp(f):
+    rdp.RDP(f.kd, EPSILON, ranked=True).render_png(io.BytesIO())
+
+
+@case('plot.finder', max_bars=1000000)
+def _plot_finder(f):
+    f.finder.plot(filename=io.BytesIO())
+
+
+# ---- universe (symbols x bars) ----
+
+@universe_case('zigzag.peak_valley_pivots_panel')
+def _panel(u):
+    zigzag.peak_valley_pivots_panel(u.X, THRESH, -THRESH)
+
+
+@universe_case('zigzag.peak_valley_pivots[loop]')
+def _panel_loop(u):
+    zigzag.pivot_memo.clear()
+    for X in u.series:
+        zigzag.peak_valley_pivots(X, THRESH, -THRESH)
+
+
+@universe_case('fractal.fractal_points_panel')
+def _fractal_panel(u):
+    fractal.fractal_points_panel(u.X, dist=5)
+
+
+def measure(fn, arg, min_time, max_runs):
+    """
+    重複執行直到總時間超過min_time或是執行max_runs次
+    :return: dict of min/median/runs
+    """
+    times = []
+    while not times or (sum(times) < min_time and len(times) < max_runs):
+        start = time.perf_counter()
+        fn(arg)
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': float(np.median(times)), 'runs': len(times)}
+
+
+def meta():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                         stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ''
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: array of 變慢超過threshold倍的key
+    """
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        ratio = results[key]['min'] / max(baseline[key]['min'], 1e-9)
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        elif ratio < 1 / threshold:
+            flag = '  faster'
+        print('%-50s %10.4fs -> %10.4fs  x%.2f%s' % (key, baseline[key]['min'], results[key]['min'], ratio, flag))
+    return regressions
+
+
+def _parse_universe(text):
+    symbols, bars = text.lower().split('x')
+    return int(symbols), int(bars)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths with synthetic data')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma separated number of bars')
+    parser.add_argument('--full', action='store_true', help='sizes 1k ~ 10M bars and universes up to 2000 symbols')
+    parser.add_argument('--universes', default='100x1000', help='comma separated SYMBOLSxBARS')
+    parser.add_argument('--filter', help='regex of case names')
+    parser.add_argument('--payloads', help='folder of recorded gethistdata.aspx responses (*.xml)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--min-time', type=float, default=0.5, help='repeat each case at least this long (seconds)')
+    parser.add_argument('--max-runs', type=int, default=5)
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio reported as regression')
+    args = parser.parse_args(argv)
+
+    sizes = [int(x) for x in args.sizes.split(',') if x]
+    universes = [_parse_universe(x) for x in args.universes.split(',') if x]
+    if args.full:
+        sizes = [1000, 10000, 100000, 1000000, 10000000]
+        universes = [(100, 1000), (2000, 1000), (500, 5000)]
+    selected = re.compile(args.filter) if args.filter else None
+    # html.parser解析XML的警告, 每次parse_bs4都會出現
+    warnings.filterwarnings('ignore', message='.*XML.*')
+    # matplotlib是第一次畫圖時才import, 不要算在第一個plot case裡面
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    def wanted(name):
+        return selected is None or selected.search(name)
+
+    results = {}
+
+    def run(key, fn, arg):
+        results[key] = measure(fn, arg, args.min_time, args.max_runs)
+        print('%-50s %10.4fs  (median %.4fs, %d runs)' % (key, results[key]['min'], results[key]['median'],
+                                                            results[key]['runs']))
+        sys.stdout.flush()
+
+    for n in sizes:
+        fixture = Fixture(n, args.seed)
+        for name, fn, max_bars in CASES:
+            if wanted(name) and (max_bars is None or n <= max_bars):
+                run('%s@%d' % (name, n), fn, fixture)
+    for symbols, n in universes:
+        if not any(wanted(name) for name, _ in UNIVERSE_CASES):
+            break
+        fixture = UniverseFixture(symbols, n, args.seed)
+        for name, fn in UNIVERSE_CASES:
+            if wanted(name):
+                run('%s@%dx%d' % (name, symbols, n), fn, fixture)
+    if args.payloads:
+        for path in sorted(glob.glob(os.path.join(args.payloads, '*.xml'))):
+            with open(path, 'rb') as f:
+                payload = f.read()
+            for name, parse in (('parse.iterparse', kdata.parse_iterparse), ('parse.bs4', kdata.parse_bs4)):
+                if wanted(name):
+                    run('%s[%s]' % (name, os.path.basename(path)), lambda p: parse(io.BytesIO(p)), payload)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'meta': meta(), 'results': results}, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('\ncompared with %s (%s)' % (args.compare, baseline.get('meta', {}).get('commit', '')))
+        if compare(results, baseline['results'], args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+畫圖前把很長的序列縮減到大約圖的像素寬度, 畫出來的樣子幾乎一樣, 但是快很多, 檔案也小很多.
+
+- lttb: Largest-Triangle-Three-Buckets, 用於折線 (例如close)
+- minmax: 每個bucket取最低的low與最高的high, 用於K棒的(low, high)垂直線
+
+Ref:
+- Sveinn Steinarsson, "Downsampling Time Series for Visual Representation", 2013
+"""
+import numpy as np
+
+# 序列長度超過 圖的像素寬度 * THRESHOLD 才縮減
+THRESHOLD = 2
+
+
+def figure_points(fig):
+    """
+    :param fig: matplotlib Figure
+    :return: 圖的像素寬度 (縮減後的目標點數)
+    """
+    return int(fig.get_figwidth() * fig.dpi)
+
+
+def needed(n, n_out):
+    """
+    長度n的序列要畫成n_out個點時, 是否需要縮減
+    """
+    return n > n_out * THRESHOLD
+
+
+def lttb(y, n_out, keep=None):
+    """
+    Largest-Triangle-Three-Buckets: 頭尾兩點保留, 中間的點分成n_out-2個bucket,
+    每個bucket選出與(前一個選到的點, 下一個bucket的平均)構成最大三角形的點
+    :param y: array of value (x是0..n-1)
+    :param n_out: 縮減後的點數
+    :param keep: optional. 一定要保留的index (例如pivots, pattern的頂點), 會額外加進結果
+    :return: 遞增的index array
+    """
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        index = np.arange(n)
+    else:
+        x = np.arange(n, dtype=float)
+        edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+        index = np.empty(n_out, dtype=int)
+        index[0], index[-1] = 0, n - 1
+        a = 0
+        for i in range(n_out - 2):
+            lo, hi = edges[i], edges[i + 1]
+            next_hi = edges[i + 2] if i + 2 < len(edges) else n
+            avg_x = x[hi:next_hi].mean()
+            avg_y = y[hi:next_hi].mean()
+            # 三角形面積的兩倍, 比大小不需要除以2
+            area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+            a = lo + int(np.argmax(area))
+            index[i + 1] = a
+    if keep is not None and len(keep) > 0:
+        index = np.union1d(index, np.asarray(keep, dtype=int))
+    return index
+
+
+def minmax(low, high, n_out):
+    """
+    把K棒分成n_out個bucket, 每個bucket以一條(最低的low, 最高的high)的線表示
+    :param low: array of low
+    :param high: array of high
+    :param n_out: bucket數目
+    :return: (x, low, high), x是bucket的中心位置
+    """
+    n = len(low)
+    if n <= n_out:
+        return np.arange(n), np.asarray(low), np.asarray(high)
+    starts = np.unique(np.linspace(0, n, n_out + 1).astype(int)[:-1])
+    ends = np.append(starts[1:], n)
+    return (starts + ends - 1) / 2.0, np.minimum.reduceat(low, starts), np.maximum.reduceat(high, starts)
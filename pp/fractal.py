@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+N-fractal轉折點: 第i根K棒的high比前後各dist根K棒的high都高時是fractal high (PEAK),
+low比前後各dist根K棒的low都低時是fractal low (VALLEY). 比較都是strict (相等不算).
+
+與ipy/NFractal.ipynb的is_high/is_low/find_all_points相同的定義, 但是以rolling max/min
+(van Herk/Gil-Werman, 與dist無關的O(n))一次算出所有的K棒, 也可以一次處理多個股號(2-D panel).
+結果是與zigzag相同的(index, direction), 可以直接給Finder.set_pivot_points搜尋pattern:
+
+    index, direction = fractal.fractal_points(kd.high, kd.low, dist=5)
+    finder.set_pivot_points(index, direction)
+
+Ref:
+- M. van Herk, "A fast algorithm for local minimum and maximum filters on rectangular and octagonal kernels", 1992
+- J. Gil, M. Werman, "Computing 2-D min, median, and max filters", 1993
+"""
+import numpy as np
+from pp.zigzag import PEAK, VALLEY
+
+
+def _rolling(X, window, ufunc, fill):
+    """
+    van Herk/Gil-Werman: 分成長度window的block, 每個window = 前一個block的suffix + 後一個block的prefix
+    """
+    X = np.asarray(X, dtype=float)
+    t_n = X.shape[-1]
+    if window < 1:
+        raise ValueError('window must be positive')
+    if window > t_n:
+        return np.empty(X.shape[:-1] + (0,))
+    blocks = -(-t_n // window)
+    padded = np.concatenate([X, np.full(X.shape[:-1] + (blocks * window - t_n,), fill)], axis=-1)
+    padded = padded.reshape(X.shape[:-1] + (blocks, window))
+    prefix = ufunc.accumulate(padded, axis=-1).reshape(X.shape[:-1] + (-1,))
+    suffix = ufunc.accumulate(padded[..., ::-1], axis=-1)[..., ::-1].reshape(X.shape[:-1] + (-1,))
+    out_n = t_n - window + 1
+    return ufunc(suffix[..., :out_n], prefix[..., window - 1:window - 1 + out_n])
+
+
+def rolling_max(X, window):
+    """
+    :param X: 1-D或2-D array (沿著最後一個軸計算), window內有nan時結果是nan
+    :param window: window的長度
+    :return: out[..., j] = X[..., j:j+window].max(), 長度是len - window + 1
+    """
+    return _rolling(X, window, np.maximum, -np.inf)
+
+
+def rolling_min(X, window):
+    """
+    :param X: 1-D或2-D array (沿著最後一個軸計算), window內有nan時結果是nan
+    :param window: window的長度
+    :return: out[..., j] = X[..., j:j+window].min(), 長度是len - window + 1
+    """
+    return _rolling(X, window, np.minimum, np.inf)
+
+
+def fractal_flags(high, low=None, dist=2):
+    """
+    找出每根K棒是否是fractal high/low. 前後不足dist根K棒, 或是前後dist根之內有nan的K棒都不是.
+    :param high: 1-D或2-D (symbols x bars) array
+    :param low: optional. 與high相同shape的array, 沒有傳的話用high (例如只有close)
+    :param dist: fractal distance
+    :return: (is_high, is_low), 與high相同shape的bool array
+    """
+    if dist < 1:
+        raise ValueError('dist must be positive')
+    high = np.asarray(high, dtype=float)
+    low = high if low is None else np.asarray(low, dtype=float)
+    if low.shape != high.shape:
+        raise ValueError('high and low must have the same shape')
+    is_high = np.zeros(high.shape, dtype=bool)
+    is_low = np.zeros(high.shape, dtype=bool)
+    t_n = high.shape[-1]
+    if t_n < 2 * dist + 1:
+        return is_high, is_low
+    center = slice(dist, t_n - dist)
+    # rolling[j]是[j, j+dist)的max/min: 第i根的左邊是rolling[i-dist], 右邊是rolling[i+1]
+    with np.errstate(invalid='ignore'):
+        window = rolling_max(high, dist)
+        is_high[..., center] = ((high[..., center] > window[..., :t_n - 2 * dist]) &
+                                (high[..., center] > window[..., dist + 1:]))
+        window = rolling_min(low, dist)
+        is_low[..., center] = ((low[..., center] < window[..., :t_n - 2 * dist]) &
+                               (low[..., center] < window[..., dist + 1:]))
+    return is_high, is_low
+
+
+def _alternate(rows, direction):
+    """
+    每個row只保留PEAK/VALLEY交替的點: 連續相同方向的點只保留第一個 (與find_all_points相同).
+    direction是0表示同一根K棒同時是high與low, 取需要的方向 (row的第一個點則是PEAK).
+    :return: (keep, direction)
+    """
+    n = len(rows)
+    k = np.arange(n)
+    new_row = np.ones(n, dtype=bool)
+    new_row[1:] = rows[1:] != rows[:-1]
+    row_start = np.maximum.accumulate(np.where(new_row, k, 0))
+    both = direction == 0
+    n_both = np.cumsum(both)
+    # 到第k個點為止(同一個row), 最後一個只有單一方向的點
+    last = np.maximum.accumulate(np.where(both, -1, k))
+    last = np.where(last >= row_start, last, -1)
+    # 處理完第k個點之後的方向: 之後每個同時是high/low的點都會反轉一次方向
+    flips = np.where(last >= 0, n_both - n_both[np.maximum(last, 0)],
+                     n_both - n_both[row_start] + both[row_start] - 1)
+    base = np.where(last >= 0, direction[np.maximum(last, 0)], PEAK)
+    state = np.where(flips % 2 == 0, base, -base).astype(np.int8)
+    keep = both.copy()
+    keep[new_row] = True
+    prev = k[~keep] - 1
+    keep[~keep] = direction[~keep] != state[prev]
+    return keep, np.where(both, state, direction).astype(np.int8)
+
+
+def fractal_points_panel(high, low=None, dist=2, alternate=True):
+    """
+    一次找出多個股號的fractal points
+    :param high: 2-D array (symbols x bars), 沒有資料的部分是nan
+    :param low: optional. 與high相同shape的array, 沒有傳的話用high
+    :param dist: fractal distance
+    :param alternate: True的話只保留PEAK/VALLEY交替的點 (與NFractal notebook的find_all_points相同),
+                      False的話回傳所有的fractal (同一根K棒同時是high與low時有兩個點, PEAK在前)
+    :return: (rows, index, direction): int32/int32/int8 array, 依(row, index)排序
+    """
+    is_high, is_low = fractal_flags(high, low, dist)
+    if is_high.ndim != 2:
+        raise ValueError('high must be a 2-D array')
+    rows, index = np.nonzero(is_high | is_low)
+    high_at, low_at = is_high[rows, index], is_low[rows, index]
+    direction = np.where(high_at & low_at, 0, np.where(high_at, PEAK, VALLEY)).astype(np.int8)
+    if alternate:
+        keep, direction = _alternate(rows, direction)
+        rows, index, direction = rows[keep], index[keep], direction[keep]
+    else:
+        both = direction == 0
+        rows = np.concatenate([rows, rows[both]])
+        index = np.concatenate([index, index[both]])
+        direction = np.concatenate([np.where(both, PEAK, direction), np.full(both.sum(), VALLEY)])
+        # stable sort: 同一根K棒PEAK在前
+        order = np.lexsort((np.arange(len(rows)), index, rows))
+        rows, index, direction = rows[order], index[order], direction[order]
+    return rows.astype(np.int32), index.astype(np.int32), direction.astype(np.int8)
+
+
+def fractal_points(high, low=None, dist=2, alternate=True):
+    """
+    找出一個序列的fractal points
+    :param high: array of high (或是close)
+    :param low: optional. array of low, 沒有傳的話用high
+    :param dist: fractal distance
+    :param alternate: 參考fractal_points_panel
+    :return: (index, direction): int32/int8 array, 可以直接給Finder.set_pivot_points
+    """
+    high = np.asarray(high, dtype=float)[np.newaxis]
+    low = None if low is None else np.asarray(low, dtype=float)[np.newaxis]
+    _, index, direction = fractal_points_panel(high, low, dist, alternate)
+    return index, direction
+
+
+def fractal_points_many(high, low=None, dists=(2, 3, 5), alternate=True):
+    """
+    一次計算多個dist
+    :param high: 1-D或2-D array
+    :param low: optional. 與high相同shape的array
+    :param dists: array of fractal distance
+    :return: dict of dist => fractal_points (1-D) 或 fractal_points_panel (2-D) 的結果
+    """
+    points = fractal_points if np.ndim(high) == 1 else fractal_points_panel
+    return dict((dist, points(high, low, dist, alternate)) for dist in dists)
@@ -2,9 +2,35 @@
 """
 提供JDDBXML K線資料
 """
-import requests
-from bs4 import BeautifulSoup
+import io
+import os
+import re
+import json
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
+from pp import memo, metrics
+try:
+    import fcntl
+except ImportError:
+    # 沒有fcntl (Windows)時只有同一個process內的lock
+    fcntl = None
+
+# KData內部的欄位格式: 一根K棒佔一筆record
+KDATA_DTYPE = np.dtype([
+    ('date', 'i4'),
+    ('open', 'f8'),
+    ('high', 'f8'),
+    ('low', 'f8'),
+    ('close', 'f8'),
+    ('volume', 'f8'),
+])
+
 
 class KBlock(object):
     """
@@ -23,32 +49,576 @@ class KBlock(object):
             self.date, self.open, self.high, self.low, self.close, self.volume)
 
 
+class KData(object):
+    """
+    一段K線資料 (依日期排序), 以一個numpy structured array (KDATA_DTYPE) 儲存.
+
+    - kd.close, kd.high ... 等欄位是原始資料的view, 不會複製
+    - kd[i] 回傳一根KBlock (只有在需要顯示時才產生)
+    - kd[i:j] 以及 kd.slice(start, end) 回傳KData (同樣是view)
+    """
+    def __init__(self, data=None):
+        """
+        :param data: structured array of KDATA_DTYPE (依日期遞增排序)
+        """
+        if data is None:
+            data = np.empty(0, dtype=KDATA_DTYPE)
+        if data.dtype != KDATA_DTYPE:
+            raise ValueError('data must be an array of KDATA_DTYPE')
+        self.data = data
+
+    @classmethod
+    def from_klist(cls, klist):
+        """
+        由array of KBlock建立KData
+        :param klist: array of KBlock
+        :return: KData
+        """
+        data = np.array([(k.date, k.open, k.high, k.low, k.close, k.volume) for k in klist],
+                        dtype=KDATA_DTYPE)
+        return cls(data)
+
+    @classmethod
+    def from_columns(cls, date, open, high, low, close, volume):
+        """
+        由各欄位的array建立KData
+        :return: KData
+        """
+        data = np.empty(len(date), dtype=KDATA_DTYPE)
+        data['date'] = date
+        data['open'] = open
+        data['high'] = high
+        data['low'] = low
+        data['close'] = close
+        data['volume'] = volume
+        return cls(data)
+
+    @property
+    def date(self):
+        return self.data['date']
+
+    @property
+    def open(self):
+        return self.data['open']
+
+    @property
+    def high(self):
+        return self.data['high']
+
+    @property
+    def low(self):
+        return self.data['low']
+
+    @property
+    def close(self):
+        return self.data['close']
+
+    @property
+    def volume(self):
+        return self.data['volume']
+
+    def slice(self, start=None, end=None):
+        """
+        取出日期介於[start, end]的K棒
+        :param start: 起始日期(yyyymmdd的int, 或是date), None表示不限制
+        :param end: 結束日期(yyyymmdd的int, 或是date), None表示不限制
+        :return: KData
+        """
+        lo = 0 if start is None else np.searchsorted(self.date, date_to_int(start), side='left')
+        hi = len(self.data) if end is None else np.searchsorted(self.date, date_to_int(end), side='right')
+        return KData(self.data[lo:hi])
+
+    def to_klist(self):
+        """
+        轉成array of KBlock (顯示用)
+        """
+        return [self[i] for i in range(len(self.data))]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        for i in range(len(self.data)):
+            yield self[i]
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return KData(self.data[item])
+        d, o, h, l, c, v = self.data[item].tolist()
+        return KBlock(d, o, h, l, c, v)
+
+    def __repr__(self):
+        if len(self.data) == 0:
+            return "<KData: empty>"
+        return "<KData: %d bars, %d-%d>" % (len(self.data), self.data['date'][0], self.data['date'][-1])
+
+
+def date_to_int(dt):
+    """
+    把date轉成yyyymmdd的int (如果已經是int則直接回傳)
+    """
+    if hasattr(dt, 'strftime'):
+        return dt.year * 10000 + dt.month * 100 + dt.day
+    return int(dt)
+
+
+def int_to_date(dt):
+    """
+    把yyyymmdd的int轉成date
+    """
+    return datetime.strptime(str(dt), "%Y%m%d").date()
+
+
+def as_kdata(klist):
+    """
+    把klist (KData或是array of KBlock) 轉成KData
+    :param klist: KData or array of KBlock
+    :return: KData
+    """
+    if isinstance(klist, KData):
+        return klist
+    return KData.from_klist(klist)
+
+
 def get_close_nparray(klist):
     """
-    取出 klist (array of KBlock) 內的close price
-    :param klist: array of KBlock
+    取出 klist (KData或是array of KBlock) 內的close price
+    :param klist: KData or array of KBlock (如果已經是close的numpy array, 則直接回傳)
     :return: nparray of close
     """
+    if isinstance(klist, KData):
+        return klist.close
+    if isinstance(klist, np.ndarray):
+        return klist
     return np.array([node.close for node in klist])
 
 
+class KDataCache(object):
+    """
+    K線資料的本地快取, 每一個(symbol, freq)存成一個.npy檔 (內容是KDATA_DTYPE的array),
+    讀取時以memory-map的方式載入, 不需要複製資料.
+
+    另外用一個.json檔紀錄這個檔案涵蓋的日期範圍(start/end, 也就是曾經查詢過的區間),
+    當查詢的區間超出範圍時, 只向server要求缺少的頭/尾, 合併後再寫回.
+
+    多個process (例如prefork的server, 或是共用同一個目錄的scanner) 可以共用同一個目錄:
+    每個key的讀取-查詢-寫回以<key>.lock的flock保護.
+    """
+    def __init__(self, folder, max_bytes=None, tail_ttl=15 * 60):
+        """
+        :param folder: 快取檔案存放的目錄
+        :param max_bytes: 快取檔案大小的上限, 超過時由最久沒有使用的檔案開始刪除. None表示不限制
+        :param tail_ttl: 最後一次更新當天(含)以後的K棒可能還沒有收盤, 超過這個秒數之後要重新抓取
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.tail_ttl = tail_ttl
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._key_locks = {}
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def getdata(self, fetch, symbol, freq, start, end):
+        """
+        查詢K線資料, 快取沒有涵蓋的部分透過fetch取得
+        :param fetch: function(symbol, freq, start, end) => KData
+        :param symbol: 股號
+        :param freq: K線週期
+        :param start: 起始日期(date)
+        :param end: 結束日期(date)
+        :return: KData
+        """
+        key = self._key(symbol, freq)
+        start_i, end_i = date_to_int(start), date_to_int(end)
+        with self._locked(key):
+            stored, meta = self._load(key)
+            if stored is None:
+                kd = fetch(symbol, freq, start, end)
+                self._store(key, kd.data, start_i, end_i, time.time())
+                return kd
+
+            parts = [stored.data]
+            new_start, new_end = min(start_i, meta['start']), max(end_i, meta['end'])
+            updated = meta['updated']
+            if start_i < meta['start']:
+                head = fetch(symbol, freq, start, int_to_date(meta['start']) - timedelta(days=1))
+                parts.insert(0, head.data)
+
+            updated_day = date_to_int(datetime.fromtimestamp(meta['updated']))
+            if end_i >= updated_day and meta['end'] >= updated_day and \
+                    time.time() - meta['updated'] > self.tail_ttl:
+                # 上次更新當天以後的K棒可能不完整, 整段重抓
+                parts[-1] = stored.data[stored.date < updated_day]
+                parts.append(fetch(symbol, freq, int_to_date(updated_day), int_to_date(new_end)).data)
+                updated = time.time()
+            elif end_i > meta['end']:
+                parts.append(fetch(symbol, freq, int_to_date(meta['end']) + timedelta(days=1), end).data)
+                updated = time.time()
+
+            if len(parts) == 1:
+                self._touch(key)
+                return stored.slice(start_i, end_i)
+
+            data = np.concatenate(parts)
+            self._store(key, data, new_start, new_end, updated)
+            return KData(data).slice(start_i, end_i)
+
+    def invalidate(self, symbol=None, freq=None):
+        """
+        清除快取. 沒有指定symbol時清除全部
+        :param symbol: 股號
+        :param freq: K線週期, None表示這個股號的所有週期
+        """
+        if symbol is not None and freq is not None:
+            keys = [self._key(symbol, freq)]
+        else:
+            prefix = None if symbol is None else self._key(symbol, '')
+            # 也包含只剩下lock檔的key (例如fetch失敗)
+            keys = set(self._keys()) | set(self._keys('.lock'))
+            keys = [k for k in sorted(keys) if prefix is None or k.startswith(prefix)]
+        for key in keys:
+            with self._locked(key):
+                self._remove(key)
+
+    def size(self):
+        """
+        目前快取檔案的總大小(bytes)
+        """
+        return sum(os.path.getsize(self._data_path(k)) for k in self._keys())
+
+    def _key(self, symbol, freq):
+        return '%s@%s' % (re.sub(r'[^0-9A-Za-z._-]', '_', symbol), freq)
+
+    def _keys(self, suffix='.npy'):
+        return [f[:-len(suffix)] for f in os.listdir(self.folder) if f.endswith(suffix)]
+
+    def _key_lock(self, key):
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            return self._key_locks[key]
+
+    @contextmanager
+    def _locked(self, key, blocking=True):
+        """
+        同一個key同時只有一個thread/process在讀寫. blocking=False時拿不到lock則yield False
+        """
+        thread_lock = self._key_lock(key)
+        if not thread_lock.acquire(blocking):
+            yield False
+            return
+        try:
+            if fcntl is None:
+                yield True
+                return
+            path = self._lock_path(key)
+            while True:
+                f = open(path, 'a')
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    f.close()
+                    yield False
+                    return
+                # 等待的期間lock檔可能被_remove刪除(另一個process會建立新的lock檔),
+                # 拿到的是已經刪除的檔案的lock時重新開啟
+                try:
+                    current = os.stat(path)
+                except OSError:
+                    current = None
+                opened = os.fstat(f.fileno())
+                if current is not None and (current.st_dev, current.st_ino) == (opened.st_dev, opened.st_ino):
+                    break
+                f.close()
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+        finally:
+            thread_lock.release()
+
+    def _data_path(self, key):
+        return os.path.join(self.folder, key + '.npy')
+
+    def _meta_path(self, key):
+        return os.path.join(self.folder, key + '.json')
+
+    def _lock_path(self, key):
+        return os.path.join(self.folder, key + '.lock')
+
+    def _load(self, key):
+        try:
+            with open(self._meta_path(key)) as f:
+                meta = json.load(f)
+            data = np.load(self._data_path(key), mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None, None
+        if meta.get('rows') != len(data):
+            # data與meta不是同一次寫入的 (例如寫到一半時中斷), 當作沒有快取
+            return None, None
+        return KData(data), meta
+
+    def _store(self, key, data, start, end, updated):
+        # 呼叫時已經拿到key的lock. 先寫入(每次不同的)暫存檔再rename, 避免讀到寫一半的檔案.
+        # meta另外紀錄data的筆數, 兩者對不上時_load當作沒有快取
+        data = np.ascontiguousarray(data)
+        self._replace(self._data_path(key), 'wb', lambda f: np.save(f, data))
+        meta = {'start': int(start), 'end': int(end), 'updated': updated, 'rows': len(data)}
+        self._replace(self._meta_path(key), 'w', lambda f: json.dump(meta, f))
+        self._evict(keep=key)
+
+    def _replace(self, path, mode, write):
+        fd, tmp = tempfile.mkstemp(dir=self.folder, prefix=os.path.basename(path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, mode) as f:
+                write(f)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def _touch(self, key):
+        try:
+            os.utime(self._data_path(key), None)
+        except OSError:
+            pass
+
+    def _remove(self, key):
+        # 呼叫時已經拿到key的lock, lock檔最後刪除 (等待中的thread/process會重新開啟)
+        for path in (self._meta_path(key), self._data_path(key), self._lock_path(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _evict(self, keep):
+        """
+        超過max_bytes時, 由最久沒有使用(mtime最舊)的檔案開始刪除
+        """
+        if self.max_bytes is None:
+            return
+        with self._evict_lock:
+            files = []
+            for key in self._keys():
+                try:
+                    st = os.stat(self._data_path(key))
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, key))
+            total = sum(f[1] for f in files)
+            for _, size, key in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                # 正在被使用(其他thread/process拿著lock)的key跳過, 不要等待以免互相deadlock
+                with self._locked(key, blocking=False) as locked:
+                    if locked:
+                        self._remove(key)
+                        total -= size
+
+
+def _item_fields(elem):
+    attrs = elem.attrib
+    if 'd' not in attrs:
+        # html.parser會把attribute轉成小寫, 這裡也比照辦理
+        attrs = dict((k.lower(), v) for k, v in attrs.items())
+    return int(attrs['d']), float(attrs['o']), float(attrs['h']), float(attrs['l']), \
+        float(attrs['c']), float(attrs['v'])
+
+
+def parse_bs4(stream):
+    """
+    以BeautifulSoup解析JDDBXML的回傳內容 (整份文件讀進記憶體後再解析)
+    :param stream: file-like object (bytes)
+    :return: KData
+    """
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(stream.read(), "html.parser")
+    items = soup.select("item")
+    # 資料是由新到舊, 直接由後往前填入
+    data = np.empty(len(items), dtype=KDATA_DTYPE)
+    for i, x in enumerate(items):
+        data[len(items) - 1 - i] = (int(x['d']), float(x['o']), float(x['h']), float(x['l']),
+                                    float(x['c']), float(x['v']))
+    return KData(data)
+
+
+def parse_iterparse(stream):
+    """
+    以iterparse逐段解析JDDBXML的回傳內容, 不需要把整份文件/DOM留在記憶體.
+    資料是由新到舊, 所以由buffer的尾端往前填, 填完就是依日期遞增的順序, 不需要再反轉.
+    :param stream: file-like object (bytes)
+    :return: KData
+    """
+    cap = 1024
+    buf = np.empty(cap, dtype=KDATA_DTYPE)
+    pos = cap
+    parents = []
+    for event, elem in ElementTree.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag.rsplit('}', 1)[-1].lower() != 'item':
+            continue
+        if pos == 0:
+            # buffer滿了: 放大一倍, 已經填好的資料搬到新buffer的尾端
+            grown = np.empty(cap * 2, dtype=KDATA_DTYPE)
+            grown[cap:] = buf
+            buf, pos, cap = grown, cap, cap * 2
+        pos -= 1
+        buf[pos] = _item_fields(elem)
+        # 處理完就從parent移除, 避免整棵樹留在記憶體
+        if parents:
+            del parents[-1][-1]
+    return KData(buf[pos:])
+
+
+# 可以選用的解析方式 (KDataSvc的parser參數)
+PARSERS = {
+    'bs4': parse_bs4,
+    'iterparse': parse_iterparse,
+}
+
+
+def parse(payload, parser='iterparse'):
+    """
+    解析JDDBXML的回傳內容 (例如事先錄下來的payload, 方便比較不同parser)
+    :param payload: bytes, 或是file-like object
+    :param parser: PARSERS的key
+    :return: KData
+    """
+    if isinstance(payload, bytes):
+        payload = io.BytesIO(payload)
+    return PARSERS[parser](payload)
+
+
+class RateLimiter(object):
+    """
+    Token bucket: 平均每秒最多rate次, 最多可以連續burst次
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """
+        取得一個token, 不夠的話就等待
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
 class KDataSvc(object):
     """
     提供K線查詢服務
     """
-    def __init__(self, server):
+    def __init__(self, server, cache=None, parser='iterparse', timeout=30, retries=3, backoff=0.5,
+                 max_workers=8, rate=None):
+        """
+        :param server: JDDBXML server
+        :param cache: optional. KDataCache, 有傳的話則先查詢本地快取
+        :param parser: 解析回傳內容的方式, PARSERS的key
+        :param timeout: 每個request的timeout(秒)
+        :param retries: 連線失敗或server回傳5xx時的重試次數
+        :param backoff: 重試之間等待的時間 = backoff * (2 ^ 重試次數)
+        :param max_workers: getdata_many同時查詢的數量 (也是connection pool的大小)
+        :param rate: optional. 對這個server每秒最多送出幾個request
+        """
         self.server = server
+        self.cache = cache
+        self.parse = PARSERS[parser]
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(rate) if rate else None
+        # 同時查詢相同(symbol, freq, start, end)的request只會送出一次
+        self.inflight = memo.SingleFlight()
+        # requests只有真的要連線時才需要, 不要拖慢只做計算的程式的import
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        # 共用同一個session, 保持keep-alive的連線
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers,
+                              max_retries=Retry(total=retries, backoff_factor=backoff,
+                                                status_forcelist=(500, 502, 503, 504)))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
-    """
-    取得K線資料(目前只支援台股股票), 回傳array of KBlock
-    """
     def getdata(self, symbol, freq, start, end):
+        """
+        取得K線資料(目前只支援台股股票), 回傳KData.
+        同時有多個相同的查詢時, 共用同一次查詢的結果 (請不要修改回傳的KData)
+        """
+        with metrics.timer('getdata'):
+            return self.inflight.do((symbol, freq, start, end), lambda: self._getdata(symbol, freq, start, end))
+
+    def _getdata(self, symbol, freq, start, end):
+        if self.cache is not None:
+            return self.cache.getdata(self.fetch, symbol, freq, start, end)
+        return self.fetch(symbol, freq, start, end)
+
+    def getdata_many(self, symbols, freq, start, end, max_workers=None):
+        """
+        同時查詢多個股號的K線資料, 依完成的順序回傳
+        :param symbols: array of 股號
+        :param max_workers: optional. 同時查詢的數量, 預設是self.max_workers
+        :return: generator of (symbol, KData, error). 成功時error是None, 失敗時KData是None
+        """
+        executor = ThreadPoolExecutor(max_workers=max_workers or self.max_workers)
+        # worker thread的各階段時間也算在呼叫者的request (Server-Timing)
+        timings = metrics.current_request()
+
+        def getdata(symbol):
+            with metrics.attach_request(timings):
+                return self.getdata(symbol, freq, start, end)
+        futures = dict((executor.submit(getdata, symbol), symbol) for symbol in symbols)
+        try:
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except Exception as e:
+                    yield futures[future], None, e
+        finally:
+            # generator提早結束時, 取消還沒開始的查詢
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def fetch(self, symbol, freq, start, end):
+        """
+        直接向server取得K線資料(不經過快取), 回傳KData
+        """
         url = 'http://%s/jddbxml/gethistdata.aspx?SID=%s&ST=1&a=%d&b=%s&d=%s' % (
             self.server, symbol, freq, start.strftime("%Y%m%d"), end.strftime("%Y%m%d"))
-        res = requests.get(url)
-        soup = BeautifulSoup(res.text, "html.parser")
-        items = soup.select("item")
-        klist = [KBlock(int(x['d']), float(x['o']), float(x['h']), float(x['l']), float(x['c']), float(x['v']))
-                 for x in items]
-        return klist[::-1]
-
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait()
+        with metrics.timer('upstream'):
+            res = self.session.get(url, stream=True, timeout=self.timeout)
+        try:
+            res.raise_for_status()
+            res.raw.decode_content = True
+            # 一邊下載一邊解析, 所以parse也包含了下載內容的時間
+            with metrics.timer('parse'):
+                kd = self.parse(res.raw)
+            metrics.fetch_bytes.observe(res.raw.tell())
+            return kd
+        finally:
+            res.close()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+計算結果的快取 (in-memory)
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+def fingerprint(X):
+    """
+    計算序列內容的指紋, 當成快取的key (內容相同的序列 => 相同的key)
+    :param X: numpy array
+    :return: (dtype, shape, digest)
+    """
+    X = np.ascontiguousarray(X)
+    digest = hashlib.blake2b(X.view(np.uint8).reshape(-1), digest_size=16).hexdigest()
+    return X.dtype.str, X.shape, digest
+
+
+class LRUMemo(object):
+    """
+    固定大小的LRU快取, 超過maxsize時移除最久沒有使用的項目. 可以在多個thread之間共用
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """
+        取得key對應的值, 沒有的話呼叫compute()計算並存起來
+        :param key: hashable
+        :param compute: function() => value
+        :return: value
+        """
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key]
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def __contains__(self, key):
+        # 不影響hits/misses與LRU的順序
+        with self._lock:
+            return key in self._data
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        """
+        :return: dict of hits/misses/size/maxsize
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+class BytesLRU(object):
+    """
+    以總bytes數限制大小的LRU快取 (例如畫好的png). 超過max_bytes時移除最久沒有使用的項目,
+    有設定ttl的話, 放進去超過ttl秒的項目視為不存在. 可以在多個thread之間共用
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=None, sizeof=len):
+        """
+        :param max_bytes: 所有項目加起來的大小上限
+        :param ttl: optional. 項目的有效秒數
+        :param sizeof: function(value) => bytes數
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """
+        取得key對應的值, 沒有的話呼叫compute()計算並存起來 (比max_bytes還大的值不會存)
+        :param key: hashable
+        :param compute: function() => value
+        :return: value
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (self.ttl is None or time.time() - item[1] < self.ttl):
+                self.hits += 1
+                self._data.move_to_end(key)
+                return item[0]
+            self.misses += 1
+        value = compute()
+        size = self.sizeof(value)
+        with self._lock:
+            self._pop(key)
+            if size <= self.max_bytes:
+                self._data[key] = (value, time.time(), size)
+                self.nbytes += size
+                while self.nbytes > self.max_bytes:
+                    self._pop(next(iter(self._data)))
+        return value
+
+    def _pop(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.nbytes -= item[2]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = self.hits = self.misses = 0
+
+    def info(self):
+        """
+        :return: dict of hits/misses/size/bytes/max_bytes
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data),
+                    'bytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    合併同時進行的相同計算: 同一個key同時只會有一個compute()在執行,
+    其他同時要求這個key的thread等待它完成並共用結果 (或是同一個exception).
+    計算完成之後不保留結果 (需要保留的話搭配LRUMemo/BytesLRU使用)
+    """
+    def __init__(self):
+        self.calls = 0
+        self.collapsed = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, compute):
+        """
+        :param key: hashable
+        :param compute: function() => value
+        :return: value
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.collapsed += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = compute()
+            return call.value
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def info(self):
+        """
+        :return: dict of calls(實際執行的次數)/collapsed(被合併的次數)/inflight
+        """
+        with self._lock:
+            return {'calls': self.calls, 'collapsed': self.collapsed, 'inflight': len(self._calls)}
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+輕量的效能統計: 各階段的latency histogram, byte數, 錯誤次數, 以及快取的命中率.
+可以輸出成Prometheus text format, 以及HTTP的Server-Timing header.
+
+預設是關閉的 (library被其他程式使用時幾乎沒有額外負擔), server.py啟動時才打開:
+
+    metrics.enable()
+    with metrics.timer('fetch'):               # pp_stage_seconds{stage="fetch"}
+        ...
+    metrics.fetch_bytes.observe(len(payload))
+    metrics.register_cache('pivot_memo', zigzag.pivot_memo.info)
+    text = metrics.render()                     # /metrics
+
+注意: 統計資料是每個process各自一份, 所以prefork模式下server.py不提供/metrics
+(每次scrape可能由不同的worker回答, counter會忽大忽小, Prometheus會誤認為reset).
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(9))      # 1KB ~ 64MB
+
+_enabled = False
+# 依註冊順序輸出
+_metrics = []
+_caches = []
+# 目前這個thread處理中的request的各階段時間 (Server-Timing)
+_request = threading.local()
+
+
+def enable(flag=True):
+    global _enabled
+    _enabled = flag
+
+
+def disable():
+    enable(False)
+
+
+def is_enabled():
+    return _enabled
+
+
+def _format_labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Counter(object):
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, value=1, *labels):
+        """
+        :param labels: label的值, 順序與建立時的labels相同
+        """
+        if not _enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append('%s%s %s' % (self.name, _format_labels(self.labels, labels), _number(value)))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels => [各bucket的次數(不累計), sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, *labels):
+        """
+        :param labels: label的值, 順序與建立時的labels相同
+        """
+        if not _enabled:
+            return
+        pos = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][pos] += 1
+            state[1] += value
+            state[2] += 1
+
+    def count(self, *labels):
+        state = self._values.get(labels)
+        return state[2] if state else 0
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += n
+                    le = 'le="%s"' % ('+Inf' if bound == float('inf') else _number(bound))
+                    lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.labels, labels, le), cumulative))
+                lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labels, labels), _number(total)))
+                lines.append('%s_count%s %d' % (self.name, _format_labels(self.labels, labels), count))
+        return lines
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+stage_seconds = Histogram('pp_stage_seconds', 'Latency of each pipeline stage', ('stage',))
+stage_errors = Counter('pp_stage_errors_total', 'Exceptions raised inside each pipeline stage', ('stage',))
+fetch_bytes = Histogram('pp_fetch_bytes', 'Size of the upstream K-line responses', buckets=BYTES_BUCKETS)
+request_seconds = Histogram('pp_request_seconds', 'Latency of HTTP requests', ('endpoint',))
+requests_total = Counter('pp_requests_total', 'HTTP requests by status', ('endpoint', 'status'))
+response_bytes = Histogram('pp_response_bytes', 'Size of HTTP response bodies', ('endpoint',),
+                           buckets=BYTES_BUCKETS)
+
+
+class _Timer(object):
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        stage_seconds.observe(seconds, self.stage)
+        if exc_type is not None:
+            stage_errors.inc(1, self.stage)
+        timings = getattr(_request, 'timings', None)
+        if timings is not None:
+            timings.append((self.stage, seconds))
+        return False
+
+
+class _NoTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+def timer(stage):
+    """
+    量測with block的執行時間, 記錄在pp_stage_seconds{stage=...} (也會出現在Server-Timing)
+    :param stage: 階段名稱, 例如'fetch', 'parse', 'zigzag', 'rdp', 'patterns', 'render'
+    """
+    if not _enabled:
+        return _NO_TIMER
+    return _Timer(stage)
+
+
+def begin_request():
+    """
+    開始記錄這個thread的request各階段的時間
+    """
+    _request.timings = [] if _enabled else None
+
+
+def current_request():
+    """
+    :return: 這個thread目前的request的時間記錄 (傳給attach_request), 沒有時回傳None
+    """
+    return getattr(_request, 'timings', None)
+
+
+@contextmanager
+def attach_request(timings):
+    """
+    在其他thread (例如thread pool的worker) 裡面, 把各階段的時間記錄到發出request的thread
+    :param timings: current_request()的結果
+    """
+    previous = getattr(_request, 'timings', None)
+    _request.timings = timings
+    try:
+        yield
+    finally:
+        _request.timings = previous
+
+
+def end_request():
+    """
+    :return: Server-Timing header的內容 (同一個階段出現多次時加總, 平行執行的階段是各thread時間的總和),
+             沒有記錄時回傳''
+    """
+    timings = getattr(_request, 'timings', None)
+    _request.timings = None
+    if not timings:
+        return ''
+    totals = {}
+    order = []
+    for stage, seconds in timings:
+        if stage not in totals:
+            order.append(stage)
+            totals[stage] = 0.0
+        totals[stage] += seconds
+    return ', '.join('%s;dur=%.1f' % (stage, totals[stage] * 1000) for stage in order)
+
+
+def register_cache(name, info):
+    """
+    在render()時輸出快取的統計: info()回傳的每個數值輸出成pp_cache_<key>{cache=name},
+    有hits/misses的話另外輸出pp_cache_hit_ratio
+    :param name: 快取名稱
+    :param info: function() => dict (例如LRUMemo.info, BytesLRU.info, SingleFlight.info)
+    """
+    _caches.append((name, info))
+
+
+def _render_caches():
+    values = {}
+    for name, info in _caches:
+        stats = info()
+        if 'hits' in stats and 'misses' in stats:
+            lookups = stats['hits'] + stats['misses']
+            stats = dict(stats, hit_ratio=float(stats['hits']) / lookups if lookups else 0.0)
+        for key, value in stats.items():
+            if isinstance(value, (int, float)):
+                values.setdefault(key, []).append((name, value))
+    lines = []
+    for key in sorted(values):
+        metric = 'pp_cache_' + key
+        lines.append('# TYPE %s gauge' % metric)
+        for name, value in values[key]:
+            lines.append('%s{cache="%s"} %s' % (metric, name, _number(value)))
+    return lines
+
+
+def render():
+    """
+    :return: 所有統計的Prometheus text format (version 0.0.4)
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    lines.extend(_render_caches())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+多個股號依日期對齊的價格資料 (close/high/low), 放在shared memory或是memory-mapped file,
+讓多個process共用同一份資料而不需要各自複製.
+
+    panel = Panel.create(kdatas)              # 主程式: 建立並載入資料
+    handle = panel.handle                     # 可以pickle, 傳給worker
+    panel = Panel.attach(handle)              # worker: 以名稱attach, 取得唯讀的numpy view
+    X = panel.series('2330.TW')               # 可以直接交給Finder, zigzag, rdp
+
+某個股號沒有資料的日期(尚未上市, 停牌...)填入nan.
+"""
+import os
+from collections import namedtuple
+from multiprocessing import shared_memory
+import numpy as np
+
+FIELDS = ('close', 'high', 'low')
+
+# attach需要的資訊. kind是'shm'或'file', name是shared memory的名稱或檔案路徑
+PanelHandle = namedtuple('PanelHandle', ['kind', 'name', 'symbols', 'ndates', 'dtype'])
+
+
+def _layout(nsymbols, ndates, dtype):
+    """
+    記憶體配置: dates(int32) + close + high + low, 每一段都對齊8 bytes
+    :return: (各段的offset, 總大小)
+    """
+    itemsize = np.dtype(dtype).itemsize
+    offsets = {'date': 0}
+    pos = (ndates * 4 + 7) // 8 * 8
+    for field in FIELDS:
+        offsets[field] = pos
+        pos += (nsymbols * ndates * itemsize + 7) // 8 * 8
+    return offsets, max(pos, 1)
+
+
+class Panel(object):
+    """
+    依日期對齊的價格資料
+    - panel.dates: int array of yyyymmdd
+    - panel.close/high/low: 2-D array (symbols x dates)
+    """
+    def __init__(self, handle, buf, shm=None, mmap=None):
+        self.handle = handle
+        self.symbols = list(handle.symbols)
+        self._rows = dict((s, i) for i, s in enumerate(self.symbols))
+        self._shm = shm
+        self._mmap = mmap
+        nsymbols, ndates = len(self.symbols), handle.ndates
+        offsets, _ = _layout(nsymbols, ndates, handle.dtype)
+        self.dates = np.ndarray(ndates, dtype='i4', buffer=buf, offset=offsets['date'])
+        for field in FIELDS:
+            setattr(self, field, np.ndarray((nsymbols, ndates), dtype=handle.dtype, buffer=buf,
+                                            offset=offsets[field]))
+
+    @classmethod
+    def create(cls, kdatas, dtype='f8', path=None):
+        """
+        建立panel並載入資料
+        :param kdatas: dict of symbol => KData, 或是array of (symbol, KData)
+        :param dtype: 價格的型別, 'f8' or 'f4' (f4只需要一半的記憶體)
+        :param path: optional. 有傳的話存成memory-mapped file, 否則放在shared memory
+        :return: Panel
+        """
+        items = list(kdatas.items()) if isinstance(kdatas, dict) else list(kdatas)
+        symbols = [symbol for symbol, _ in items]
+        dates = np.unique(np.concatenate([kd.date for _, kd in items] or [np.empty(0, dtype='i4')]))
+        _, size = _layout(len(symbols), len(dates), dtype)
+        if path:
+            mmap = np.memmap(path, dtype=np.uint8, mode='w+', shape=(size,))
+            panel = cls(PanelHandle('file', path, tuple(symbols), len(dates), np.dtype(dtype).str), mmap,
+                        mmap=mmap)
+        else:
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            panel = cls(PanelHandle('shm', shm.name, tuple(symbols), len(dates), np.dtype(dtype).str), shm.buf,
+                        shm=shm)
+        panel.dates[:] = dates
+        for i, (_, kd) in enumerate(items):
+            pos = np.searchsorted(dates, kd.date)
+            for field in FIELDS:
+                row = getattr(panel, field)[i]
+                row[:] = np.nan
+                row[pos] = getattr(kd, field)
+        if panel._mmap is not None:
+            panel._mmap.flush()
+        return panel
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        以handle attach已經建立的panel, 回傳的array是唯讀的
+        :param handle: PanelHandle (panel.handle)
+        :return: Panel
+        """
+        if handle.kind == 'file':
+            mmap = np.memmap(handle.name, dtype=np.uint8, mode='r')
+            panel = cls(handle, mmap, mmap=mmap)
+        else:
+            # attach的一方不擁有這塊記憶體, 不要讓resource tracker追蹤 (python 3.13+).
+            # 舊版python由multiprocessing產生的worker與建立者共用同一個resource tracker, 也不會提早刪除
+            try:
+                shm = shared_memory.SharedMemory(name=handle.name, track=False)
+            except TypeError:
+                shm = shared_memory.SharedMemory(name=handle.name)
+            panel = cls(handle, shm.buf, shm=shm)
+        for name in ('dates',) + FIELDS:
+            getattr(panel, name).flags.writeable = False
+        return panel
+
+    def row(self, symbol):
+        """
+        :return: symbol在panel裡面的row index
+        """
+        return self._rows[symbol]
+
+    def valid_range(self, symbol):
+        """
+        :return: (start, end), 這個股號有資料的範圍是dates[start:end]
+        """
+        valid = np.flatnonzero(~np.isnan(self.close[self.row(symbol)]))
+        if len(valid) == 0:
+            return 0, 0
+        return valid[0], valid[-1] + 1
+
+    def series(self, symbol, field='close'):
+        """
+        取出一個股號的價格序列 (去掉頭尾沒有資料的部分), 是panel的view, 不會複製
+        :param symbol: 股號
+        :param field: 'close', 'high' or 'low'
+        :return: 1-D array
+        """
+        start, end = self.valid_range(symbol)
+        return getattr(self, field)[self.row(symbol), start:end]
+
+    def nbytes(self):
+        return _layout(len(self.symbols), self.handle.ndates, self.handle.dtype)[1]
+
+    def detach(self):
+        """
+        釋放這個process對panel的reference (不會刪除資料)
+        """
+        self.dates = self.close = self.high = self.low = None
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError:
+                # 外面還有view在使用, 等它們被回收時才會真正釋放
+                pass
+            self._shm = None
+        self._mmap = None
+
+    def unlink(self):
+        """
+        刪除panel的資料 (只有建立panel的一方需要呼叫)
+        """
+        if self.handle.kind == 'file':
+            self.detach()
+            os.remove(self.handle.name)
+        else:
+            if self._shm is not None:
+                self._shm.unlink()
+            else:
+                # 已經detach: 以名稱重新開啟後刪除
+                shm = shared_memory.SharedMemory(name=self.handle.name)
+                shm.unlink()
+                shm.close()
+            self.detach()
@@ -8,311 +8,155 @@ Ref:
 """
 from __future__ import print_function
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.figure import Figure
-from matplotlib import collections as mc
-from matplotlib.backends.backend_agg import FigureCanvasAgg
-from pp import kdata
+from pp import kdata, zigzag, fractal, metrics, downsample
+from pp.patternspec import PatternSpec, compile_patterns
 
 PEAK, VALLEY = 1, -1
 
-
-def _is_close_enough(p1, p2, delta):
-    """
-    檢查p1,p2是否是在一直線上面 (TODO: 目前只判斷Y的數值(水平線), 以後的版本要改成判斷任何直線)
-    :param p1: 第一個點的Y
-    :param p2: 第二個點的Y
-    :param delta: 差異範圍
-    :return:
-    """
-    return abs(p1 - p2) / p2 <= delta
-
-
-def _is_hs(X, pv_points, cur, delta):
-    """
-    Return true if 'cur'這個點是一個頭肩頂(head-and-shoulder)的pattern
-    :param X: array of close price
-    :param pv_points: pivot point, array of (index, direction)
-    :param cur: 目前的點
-    :param delta: E1/E5, E2/E4的容忍範圍
-    :return: True or False
-    """
-    if cur > len(pv_points) - 5:
-        return False
-
-    # E1必須是個max
-    _, direction = pv_points[cur]
-    if direction != PEAK:
-        return False
-
-    # 接下來5個點的數值 = e1,e2,e3,e4,e5
-    e1, e2, e3, e4, e5 = X[[p[0] for p in pv_points[cur:cur+5]]]
-
-    # TODO 可以把e1,e2,e3,e4,e5這幾個點之間的距離考慮進去
-
-    # E3要比E1/E5高
-    if e3 < e1 or e3 < e5:
-        return False
-
-    e15 = (e1 + e5)/2
-    e24 = (e2 + e4)/2
-    return \
-        _is_close_enough(e1, e15, delta) and \
-        _is_close_enough(e5, e15, delta) and \
-        _is_close_enough(e2, e24, delta) and \
-        _is_close_enough(e4, e24, delta)
-
-
-def _is_ihs(X, pv_points, cur, delta):
-    """
-    Return true if 'cur'這個點是一個反向頭肩頂(inverted head-and-shoulder)的pattern
-    :param X: array of close price
-    :param pv_points: pivot point, array of (index, direction)
-    :param cur: 目前的點
-    :param delta: E1/E5, E2/E4的容忍範圍
-    :return:
-    """
-    if cur > len(pv_points) - 5:
-        return False
-
-    # TODO 可以把e1,e2,e3,e4,e5這幾個點之間的距離考慮進去
-
-    # E1必須是個min
-    _, direction = pv_points[cur]
-    if direction != VALLEY:
-        return False
-
-    # 接下來5個點的數值 = e1,e2,e3,e4,e5
-    e1, e2, e3, e4, e5 = X[[p[0] for p in pv_points[cur:cur+5]]]
-
-    # E3要比E1/E5低
-    if e3 > e1 or e3 > e5:
-        return False
-
-    e15 = (e1 + e5)/2
-    e24 = (e2 + e4)/2
-    return \
-        _is_close_enough(e1, e15, delta) and \
-        _is_close_enough(e5, e15, delta) and \
-        _is_close_enough(e2, e24, delta) and \
-        _is_close_enough(e4, e24, delta)
-
-
-def _is_double_bottom(X, pv_points, cur, delta):
-    """
-    Return true if 'cur'這個點是一個double-bottom的pattern
-    :param X: array of close price
-    :param pv_points: pivot point, array of (index, direction)
-    :param cur: 目前的點
-    :param delta: E2/E4的容忍範圍
-    :return: True or False
-    """
-    if cur > len(pv_points) - 5:
-        return False
-
-    # E1必須是個max
-    _, direction = pv_points[cur]
-    if direction != PEAK:
-        return False
-
-    # 接下來5個點的數值 = e1,e2,e3,e4,e5
-    e1, e2, e3, e4, e5 = X[[p[0] for p in pv_points[cur:cur+5]]]
-
-    # E3要比E1/E5低
-    if e3 > e1 or e3 > e5:
-        return False
-
-    # E2/E4要接近
-    e24 = (e2 + e4)/2
-    return \
-        _is_close_enough(e2, e24, delta) and \
-        _is_close_enough(e4, e24, delta)
-
-
-def _is_double_top(X, pv_points, cur, delta):
-    """
-    Return true if 'cur'這個點是一個double-top的pattern
-    :param X: array of close price
-    :param pv_points: pivot point, array of (index, direction)
-    :param cur: 目前的點
-    :param delta: E2/E4的容忍範圍
-    :return: True or False
-    """
-    if cur > len(pv_points) - 5:
-        return False
-
-    # E1必須是個min
-    _, direction = pv_points[cur]
-    if direction != VALLEY:
-        return False
-
-    # 接下來5個點的數值 = e1,e2,e3,e4,e5
-    e1, e2, e3, e4, e5 = X[[p[0] for p in pv_points[cur:cur+5]]]
-
-    # E3要比E1/E5高
-    if e3 < e1 or e3 < e5:
-        return False
-
-    # E2/E4要接近
-    e24 = (e2 + e4)/2
-    return \
-        _is_close_enough(e2, e24, delta) and \
-        _is_close_enough(e4, e24, delta)
-
-
-def _is_triple_bottom(X, pv_points, cur, delta):
-    """
-    Return true if 'cur'這個點是一個triple-bottom的pattern
-    :param X: array of close price
-    :param pv_points: pivot point, array of (index, direction)
-    :param cur: 目前的點
-    :param delta: E2/E4/E6, E3/E5的容忍範圍
-    :return: True or False
-    """
-    if cur > len(pv_points) - 7:
-        return False
-
-    # E1必須是個max
-    _, direction = pv_points[cur]
-    if direction != PEAK:
-        return False
-
-    # 接下來7個點的數值 = e1,e2,e3,e4,e5,e6,e7
-    e1, e2, e3, e4, e5, e6, e7 = X[[p[0] for p in pv_points[cur:cur+7]]]
-
-    # E3要比E1/E7低
-    if e3 > e1 or e3 > e7:
-        return False
-
-    # E5要比E1/E7低
-    if e5 > e1 or e5 > e7:
-        return False
-
-    # E2/E4/E6要接近
-    e246 = (e2 + e4 + e6)/3
-    if not _is_close_enough(e2, e246, delta) or \
-       not _is_close_enough(e4, e246, delta) or \
-       not _is_close_enough(e6, e246, delta):
-        return False
-
-    # E3/E5要接近
-    e35 = (e3 + e5) / 2
-    if not _is_close_enough(e3, e35, delta) or \
-       not _is_close_enough(e5, e35, delta):
-        return False
-
-    return True
-
-
-def _is_triple_top(X, pv_points, cur, delta):
+# 內建的pattern (E1..En是連續的pivot points)
+BUILTIN_PATTERNS = [
+    # 頭肩頂(head-and-shoulder): E1是max, E3要比E1/E5高, E1/E5要接近, E2/E4要接近
+    PatternSpec('hs', 5, PEAK, order=[(3, '>=', 1), (3, '>=', 5)], equal=[(1, 5), (2, 4)]),
+    # 反向頭肩頂(inverted head-and-shoulder): E1是min, E3要比E1/E5低, E1/E5要接近, E2/E4要接近
+    PatternSpec('ihs', 5, VALLEY, order=[(3, '<=', 1), (3, '<=', 5)], equal=[(1, 5), (2, 4)]),
+    # double-top: E1是min, E3要比E1/E5高, E2/E4要接近
+    PatternSpec('double_top', 5, VALLEY, order=[(3, '>=', 1), (3, '>=', 5)], equal=[(2, 4)]),
+    # double-bottom: E1是max, E3要比E1/E5低, E2/E4要接近
+    PatternSpec('double_bottom', 5, PEAK, order=[(3, '<=', 1), (3, '<=', 5)], equal=[(2, 4)]),
+    # triple-top: E1是min, E3/E5要比E1/E7高, E2/E4/E6要接近, E3/E5要接近
+    PatternSpec('triple_top', 7, VALLEY,
+                order=[(3, '>=', 1), (3, '>=', 7), (5, '>=', 1), (5, '>=', 7)], equal=[(2, 4, 6), (3, 5)]),
+    # triple-bottom: E1是max, E3/E5要比E1/E7低, E2/E4/E6要接近, E3/E5要接近
+    PatternSpec('triple_bottom', 7, PEAK,
+                order=[(3, '<=', 1), (3, '<=', 7), (5, '<=', 1), (5, '<=', 7)], equal=[(2, 4, 6), (3, 5)]),
+]
+
+_builtin = compile_patterns(BUILTIN_PATTERNS)
+# 每個內建的pattern單獨compile一份, find_hs等只需要比對自己的pattern
+_single = dict((spec.name, compile_patterns([spec])) for spec in BUILTIN_PATTERNS)
+
+# 內建的pattern名稱, 以及每個pattern包含幾個pivot points
+PATTERN_SIZES = _builtin.sizes
+
+
+def match_patterns(X, pv_index, pv_dir, delta, patterns=None):
     """
-    Return true if 'cur'這個點是一個triple-top的pattern
+    一次檢查所有pivot point, 找出所有的pattern
     :param X: array of close price
-    :param pv_points: pivot point, array of (index, direction)
-    :param cur: 目前的點
-    :param delta: E2/E4/E6, E3/E5的容忍範圍
-    :return: True or False
+    :param pv_index: array of pivot index
+    :param pv_dir: array of pivot direction (PEAK/VALLEY)
+    :param delta: 容忍範圍
+    :param patterns: optional. CompiledPatterns, 預設是內建的pattern
+    :return: dict of pattern name => boolean array (長度與pv_index相同, True表示從這個pivot開始符合pattern)
     """
-    if cur > len(pv_points) - 7:
-        return False
-
-    # E1必須是個min
-    _, direction = pv_points[cur]
-    if direction != VALLEY:
-        return False
-
-    # 接下來7個點的數值 = e1,e2,e3,e4,e5,e6,e7
-    e1, e2, e3, e4, e5, e6, e7 = X[[p[0] for p in pv_points[cur:cur+7]]]
-
-    # E3要比E1/E7高
-    if e3 < e1 or e3 < e7:
-        return False
-
-    # E5要比E1/E7高
-    if e5 < e1 or e5 < e7:
-        return False
-
-    # E2/E4/E6要接近
-    e246 = (e2 + e4 + e6)/3
-    if not _is_close_enough(e2, e246, delta) or \
-       not _is_close_enough(e4, e246, delta) or \
-       not _is_close_enough(e6, e246, delta):
-        return False
-
-    # E3/E5要接近
-    e35 = (e3 + e5) / 2
-    if not _is_close_enough(e3, e35, delta) or \
-       not _is_close_enough(e5, e35, delta):
-        return False
-
-    return True
+    return (patterns or _builtin).match(X, pv_index, pv_dir, delta)
 
 
 class Finder(object):
     def __init__(self, klist):
         """
         Construct a PatternFinder object
-        :param klist: array of KBlock
-        """
-        self.klist = klist
-        self.X = kdata.get_close_nparray(klist)
-        # self.pivots is an array of (VALLEY, 0, PEAK): 紀錄每一個點的屬性
-        self.pivots = []
-        # self.pv_points is an array of (index, DIR): 把PEAK/VALLEY points拉出來, 方便計算
-        self.pv_points = []
+        :param klist: KData, array of KBlock, 或是close的numpy array (例如Panel.series的view)
+        """
+        if isinstance(klist, np.ndarray):
+            self.klist = None
+            self.X = klist
+        else:
+            self.klist = kdata.as_kdata(klist)
+            self.X = self.klist.close
+        # pivot points以兩個平行的array表示: pv_index(int32)是pivot的位置, pv_dir(int8)是PEAK/VALLEY
+        self.pv_index = np.empty(0, dtype=np.int32)
+        self.pv_dir = np.empty(0, dtype=np.int8)
+        # dense的pivots (長度與self.X相同), 畫圖需要時才產生
+        self._pivots = None
+
+    @property
+    def pivots(self):
+        """
+        array of (VALLEY, 0, PEAK): 紀錄每一個點的屬性 (由pv_index/pv_dir產生)
+        """
+        if self._pivots is None:
+            self._pivots = np.zeros(len(self.X), dtype='i1')
+            self._pivots[self.pv_index] = self.pv_dir
+        return self._pivots
+
+    @property
+    def pv_points(self):
+        """
+        array of (index, DIR). 舊的格式, 請改用pv_index/pv_dir
+        """
+        return list(zip(self.pv_index.tolist(), self.pv_dir.tolist()))
 
     def init_pivots(self, thresh):
         """
-        找出 zigzag points. 產出 self.pivots, 以及 self.pv_points
+        找出 zigzag points. 產出 self.pv_index, 以及 self.pv_dir
         :param thresh: The minimum relative change necessary to define a peak/valley
         :return:
         """
-        up_thresh = thresh
-        down_thresh = -1 * thresh
-        initial_pivot = self._identify_initial_pivot(self.X, up_thresh, down_thresh)
-        t_n = len(self.X)
-        self.pivots = np.zeros(t_n, dtype='i1')
-        self.pivots[0] = initial_pivot
+        with metrics.timer('pivots'):
+            self.set_pivots(zigzag.peak_valley_pivots(self.X, thresh, -thresh))
 
-        # Adding one to the relative change thresholds saves operations. Instead
-        # of computing relative change at each point as x_j / x_i - 1, it is
-        # computed as x_j / x_1. Then, this value is compared to the threshold + 1.
-        # This saves (t_n - 1) subtractions.
-        up_thresh += 1
-        down_thresh += 1
-
-        trend = -initial_pivot
-        last_pivot_t = 0
-        last_pivot_x = self.X[0]
-        for t in range(1, len(self.X)):
-            x = self.X[t]
-            r = x / last_pivot_x
+    def init_pivots_from_hierarchy(self, hierarchy, thresh):
+        """
+        由同一個序列的zigzag.PivotHierarchy算出pivots, 只重新掃描min_thresh的pivots
+        (以及少數會影響結果的中間K棒). 結果與init_pivots(thresh)相同
+        :param hierarchy: zigzag.PivotHierarchy
+        :param thresh: 不可以小於hierarchy.min_thresh
+        """
+        with metrics.timer('pivots'):
+            self.set_pivot_points(*hierarchy.pivot_points(thresh))
 
-            if trend == -1:
-                if r >= up_thresh:
-                    self.pivots[last_pivot_t] = trend
-                    trend = 1
-                    last_pivot_x = x
-                    last_pivot_t = t
-                elif x < last_pivot_x:
-                    last_pivot_x = x
-                    last_pivot_t = t
+    def init_fractal_pivots(self, dist, high_low=True):
+        """
+        以N-fractal找出pivot points (比zigzag便宜的另一種轉折點), 參考pp.fractal
+        :param dist: fractal distance
+        :param high_low: True的話以high/low欄位判斷 (只有close的時候一律用close)
+        """
+        with metrics.timer('pivots'):
+            if high_low and self.klist is not None:
+                self.set_pivot_points(*fractal.fractal_points(self.klist.high, self.klist.low, dist))
             else:
-                if r <= down_thresh:
-                    self.pivots[last_pivot_t] = trend
-                    trend = -1
-                    last_pivot_x = x
-                    last_pivot_t = t
-                elif x > last_pivot_x:
-                    last_pivot_x = x
-                    last_pivot_t = t
+                self.set_pivot_points(*fractal.fractal_points(self.X, dist=dist))
+
+    def set_pivots(self, pivots):
+        """
+        直接設定已經算好的pivots
+        :param pivots: array of (VALLEY, 0, PEAK), 長度與self.X相同
+        """
+        pivots = np.asarray(pivots)
+        index = np.flatnonzero(pivots)
+        self.set_pivot_points(index, pivots[index])
 
-        if last_pivot_t == t_n-1:
-            self.pivots[last_pivot_t] = trend
-        elif self.pivots[t_n-1] == 0:
-            self.pivots[t_n-1] = -trend
+    def set_pivot_points(self, index, direction):
+        """
+        直接設定已經算好的pivot points (例如zigzag.peak_valley_pivots_panel或PivotHierarchy.pivot_points的結果)
+        :param index: array of pivot index (遞增)
+        :param direction: array of pivot direction (PEAK/VALLEY)
+        """
+        self.pv_index = np.asarray(index, dtype=np.int32)
+        self.pv_dir = np.asarray(direction, dtype=np.int8)
+        self._pivots = None
 
-        self.pv_points = [(i, self.pivots[i]) for i in np.arange(len(self.X))[self.pivots != 0]]
+    @staticmethod
+    def init_pivots_many(finders, thresh):
+        """
+        一次算出多個Finder的zigzag points (數量達到zigzag.PANEL_MIN_ROWS時以peak_valley_pivots_panel同時處理)
+        :param finders: array of Finder
+        :param thresh: The minimum relative change necessary to define a peak/valley
+        """
+        if len(finders) < zigzag.PANEL_MIN_ROWS:
+            for f in finders:
+                f.init_pivots(thresh)
+            return
+        t_n = max(len(f.X) for f in finders)
+        X = np.full((len(finders), t_n), np.nan)
+        for i, f in enumerate(finders):
+            X[i, :len(f.X)] = f.X
+        _, (rows, index, direction) = zigzag.peak_valley_pivots_panel(X, thresh, -thresh)
+        # rows是遞增的, 每個Finder的pivot points是其中連續的一段
+        bounds = np.searchsorted(rows, np.arange(len(finders) + 1))
+        for i, f in enumerate(finders):
+            f.set_pivot_points(index[bounds[i]:bounds[i+1]], direction[bounds[i]:bounds[i+1]])
 
     def plot(self, pattern=[], width=12, height=9, filename=''):
         """
@@ -323,44 +167,63 @@ class Finder(object):
         :param filename: optional. 如果有傳的話, 則render成png file
         :return:
         """
+        # matplotlib只有畫圖時才import (import很花時間)
+        from matplotlib.figure import Figure
+        from matplotlib import collections as mc
         size = (width, height)
         if filename:
             fig = Figure(figsize=size)
         else:
+            import matplotlib.pyplot as plt
             fig = plt.figure(figsize=size)
         ax = fig.add_subplot(111)
         ax.set_xlim(-10, len(self.X)+10)
-        highs = [k.high for k in self.klist]
-        lows = [k.low for k in self.klist]
-        ax.set_ylim(min(lows)*0.99, max(highs)*1.01)
-        lines = [[(x, lows[x]), (x, highs[x])] for x in range(len(self.X))]
-        colors = [(0, 0, 0, 0.3) for x in range(len(self.X))]
-        lc = mc.LineCollection(lines, colors=colors)
+        # 只有close的時候, 以close代替high/low
+        highs = self.klist.high if self.klist is not None else self.X
+        lows = self.klist.low if self.klist is not None else self.X
+        ax.set_ylim(lows.min()*0.99, highs.max()*1.01)
+        # 每根K棒畫一條(x, low)-(x, high)的垂直線, shape = (n, 2, 2). K棒比像素多很多時, 先合併成每個像素一條
+        n_out = downsample.figure_points(fig)
+        if downsample.needed(len(self.X), n_out):
+            x, lows, highs = downsample.minmax(lows, highs, n_out)
+        else:
+            x = np.arange(len(self.X))
+        lines = np.stack([np.column_stack([x, lows]), np.column_stack([x, highs])], axis=1)
+        lc = mc.LineCollection(lines, colors=(0, 0, 0, 0.3))
         ax.add_collection(lc)
-        ax.plot(np.arange(len(self.X))[self.pivots != 0], self.X[self.pivots != 0], 'k-')
+        ax.plot(self.pv_index, self.X[self.pv_index], 'k-')
         if len(pattern) > 0:
             y = [self.X[i] for i in pattern]
             ax.plot(pattern, y, color='b', linewidth=2)
             ax.scatter(pattern, y, color='r')
         if filename:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
             canvas = FigureCanvasAgg(fig)
             canvas.print_png(filename)
         else:
             plt.show()
 
-    def find_pattern(self, fncname, count, delta):
+    def find_pattern(self, spec, delta):
         """
-        搜尋某種pattern (as defined by fncname)
-        :param fncname: name of the function
-        :param count: # of points in this pattern
-        :param delta:
+        搜尋某種pattern (as defined by spec)
+        :param spec: PatternSpec
+        :param delta: 誤差容忍值
         :return: array of patterns, 每一個pattern是一個array of index
         """
-        patterns = []
-        for i in range(len(self.pv_points)):
-            if fncname(self.X, self.pv_points, i, delta):
-                patterns.append([pt[0] for pt in self.pv_points[i:i+count]])
-        return patterns
+        return self.find_all(delta, compile_patterns([spec]))[spec.name]
+
+    def find_all(self, delta=0.005, patterns=None):
+        """
+        一次搜尋所有的pattern
+        :param delta: 誤差容忍值
+        :param patterns: optional. CompiledPatterns, 預設是內建的pattern (BUILTIN_PATTERNS)
+        :return: dict of pattern name => array of patterns, 每一個pattern是一個array of index
+        """
+        patterns = patterns or _builtin
+        with metrics.timer('patterns'):
+            matches = match_patterns(self.X, self.pv_index, self.pv_dir, delta, patterns)
+            return dict((name, [self.pv_index[i:i+patterns.sizes[name]].tolist() for i in np.flatnonzero(found)])
+                        for name, found in matches.items())
 
     def find_hs(self, delta=0.005):
         """
@@ -368,7 +231,7 @@ class Finder(object):
         :param delta: 頸線的誤差容忍值
         :return: array of patterns, 每一個pattern是一個array of index
         """
-        return self.find_pattern(_is_hs, 5, delta)
+        return self.find_all(delta, _single['hs'])['hs']
 
     def find_ihs(self, delta=0.005):
         """
@@ -376,7 +239,7 @@ class Finder(object):
         :param delta: 頸線的誤差容忍值
         :return: array of patterns, 每一個pattern是一個array of index
         """
-        return self.find_pattern(_is_ihs, 5, delta)
+        return self.find_all(delta, _single['ihs'])['ihs']
 
     def find_double_top(self, delta=0.005):
         """
@@ -384,7 +247,7 @@ class Finder(object):
         :param delta: E2/E4的誤差容忍值
         :return: array of patterns, 每一個pattern是一個array of index
         """
-        return self.find_pattern(_is_double_top, 5, delta)
+        return self.find_all(delta, _single['double_top'])['double_top']
 
     def find_double_bottom(self, delta=0.005):
         """
@@ -392,7 +255,7 @@ class Finder(object):
         :param delta: E2/E4的誤差容忍值
         :return: array of patterns, 每一個pattern是一個array of index
         """
-        return self.find_pattern(_is_double_bottom, 5, delta)
+        return self.find_all(delta, _single['double_bottom'])['double_bottom']
 
     def find_triple_top(self, delta=0.005):
         """
@@ -400,7 +263,7 @@ class Finder(object):
         :param delta: E2/E4/E6 and E3/E5的誤差容忍值
         :return: array of patterns, 每一個pattern是一個array of index
         """
-        return self.find_pattern(_is_triple_top, 7, delta)
+        return self.find_all(delta, _single['triple_top'])['triple_top']
 
     def find_triple_bottom(self, delta=0.005):
         """
@@ -408,36 +271,4 @@ class Finder(object):
         :param delta: E2/E4/E6 and E3/E5的誤差容忍值
         :return: array of patterns, 每一個pattern是一個array of index
         """
-        return self.find_pattern(_is_triple_bottom, 7, delta)
-
-    @staticmethod
-    def _identify_initial_pivot(X, up_thresh, down_thresh):
-        """Quickly identify the X[0] as a peak or valley."""
-        x_0 = X[0]
-        max_x = x_0
-        max_t = 0
-        min_x = x_0
-        min_t = 0
-        up_thresh += 1
-        down_thresh += 1
-
-        for t in range(1, len(X)):
-            x_t = X[t]
-
-            if x_t / min_x >= up_thresh:
-                return VALLEY if min_t == 0 else PEAK
-
-            if x_t / max_x <= down_thresh:
-                return PEAK if max_t == 0 else VALLEY
-
-            if x_t > max_x:
-                max_x = x_t
-                max_t = t
-
-            if x_t < min_x:
-                min_x = x_t
-                min_t = t
-
-        t_n = len(X)-1
-        return VALLEY if x_0 < X[t_n] else PEAK
-
+        return self.find_all(delta, _single['triple_bottom'])['triple_bottom']
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+以宣告的方式描述pivot pattern, 並編譯成向量化的matcher.
+
+一個pattern由連續的n個pivot points (E1..En) 組成:
+- start: E1必須是PEAK或是VALLEY
+- order: E_i與E_j的大小關係, 例如 (3, '>=', 1) 表示E3 >= E1
+- equal: 必須接近的點, 例如 (2, 4, 6) 表示E2/E4/E6與三者平均值的差異都在delta以內
+- spacing: optional. E_i與E_j之間相隔的K棒數目的範圍, 例如 (1, 5, 20, None) 表示E1到E5至少20根K棒
+
+所有pattern的條件拆成不重複的基本條件(atom), 每個atom對所有pivot一次算完,
+最後以一個矩陣運算同時判斷所有pattern, 所以pattern數量增加時幾乎不會變慢.
+"""
+import operator
+import numpy as np
+
+PEAK, VALLEY = 1, -1
+
+_OPS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+
+class PatternSpec(object):
+    """
+    一種pivot pattern的定義
+    """
+    def __init__(self, name, size, start, order=(), equal=(), spacing=()):
+        """
+        :param name: pattern名稱
+        :param size: 包含幾個pivot points
+        :param start: E1的方向, PEAK or VALLEY
+        :param order: array of (i, op, j), op是'>', '>=', '<', '<='其中之一
+        :param equal: array of (i, j, ...), 每一組點都必須接近這組點的平均值
+        :param spacing: array of (i, j, min_bars, max_bars), min_bars/max_bars可以是None(不限制)
+        """
+        if start not in (PEAK, VALLEY):
+            raise ValueError('start must be PEAK or VALLEY')
+        for i, op, j in order:
+            if op not in _OPS:
+                raise ValueError('unknown operator: %s' % op)
+            self._check_points(size, (i, j))
+        for group in equal:
+            self._check_points(size, group)
+        for i, j, _, _ in spacing:
+            self._check_points(size, (i, j))
+        self.name = name
+        self.size = size
+        self.start = start
+        self.order = [tuple(x) for x in order]
+        self.equal = [tuple(sorted(g)) for g in equal]
+        self.spacing = [tuple(x) for x in spacing]
+
+    @staticmethod
+    def _check_points(size, points):
+        for p in points:
+            if not 1 <= p <= size:
+                raise ValueError('point E%d is out of range (E1..E%d)' % (p, size))
+
+    def atoms(self):
+        """
+        這個pattern需要的基本條件
+        """
+        atoms = [('has', self.size), ('start', self.start)]
+        atoms.extend(('order', i, op, j) for i, op, j in self.order)
+        atoms.extend(('equal',) + g for g in self.equal)
+        atoms.extend(('spacing', i, j, lo, hi) for i, j, lo, hi in self.spacing)
+        return atoms
+
+    def __repr__(self):
+        return "<PatternSpec %s: %d points>" % (self.name, self.size)
+
+
+class CompiledPatterns(object):
+    """
+    一組編譯好的PatternSpec, 可以一次比對所有pattern
+    """
+    def __init__(self, specs):
+        """
+        :param specs: array of PatternSpec (名稱不可以重複)
+        """
+        self.specs = list(specs)
+        self.names = [spec.name for spec in self.specs]
+        if len(set(self.names)) != len(self.names):
+            raise ValueError('duplicated pattern name')
+        self.sizes = dict((spec.name, spec.size) for spec in self.specs)
+        self.window = max([spec.size for spec in self.specs] or [1])
+        # 所有pattern的atom去除重複, requires[p, a]表示pattern p需要atom a
+        self.atoms = []
+        position = {}
+        for spec in self.specs:
+            for atom in spec.atoms():
+                if atom not in position:
+                    position[atom] = len(self.atoms)
+                    self.atoms.append(atom)
+        self.requires = np.zeros((len(self.specs), len(self.atoms)), dtype=np.float32)
+        for p, spec in enumerate(self.specs):
+            for atom in spec.atoms():
+                self.requires[p, position[atom]] = 1
+
+    def match(self, X, pv_index, pv_dir, delta):
+        """
+        比對所有pattern
+        :param X: array of close price
+        :param pv_index: array of pivot index
+        :param pv_dir: array of pivot direction (PEAK/VALLEY)
+        :param delta: equal條件的容忍範圍
+        :return: dict of pattern name => boolean array (長度與pv_index相同, True表示從這個pivot開始符合pattern)
+        """
+        m = len(pv_index)
+        k = self.window
+        # 後面補k個點 (價格補nan), 讓每一個pivot都有完整的window, 不足的部分由'has'條件排除
+        prices = np.full(m + k, np.nan)
+        prices[:m] = X[pv_index]
+        index = np.zeros(m + k, dtype=np.int64)
+        index[:m] = pv_index
+        E = np.lib.stride_tricks.sliding_window_view(prices, k)[:m]
+        T = np.lib.stride_tricks.sliding_window_view(index, k)[:m]
+
+        failed = np.empty((m, len(self.atoms)), dtype=np.float32)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for a, atom in enumerate(self.atoms):
+                failed[:, a] = ~self._eval_atom(atom, E, T, pv_dir, delta)
+        # 一個pattern成立 <=> 它需要的atom沒有任何一個失敗
+        matched = np.dot(failed, self.requires.T) == 0
+        return dict((name, matched[:, p]) for p, name in enumerate(self.names))
+
+    @staticmethod
+    def _eval_atom(atom, E, T, pv_dir, delta):
+        kind = atom[0]
+        if kind == 'has':
+            m = len(pv_dir)
+            return np.arange(m) <= m - atom[1]
+        if kind == 'start':
+            return pv_dir == atom[1]
+        if kind == 'order':
+            _, i, op, j = atom
+            return _OPS[op](E[:, i - 1], E[:, j - 1])
+        if kind == 'equal':
+            group = atom[1:]
+            total = E[:, group[0] - 1]
+            for g in group[1:]:
+                total = total + E[:, g - 1]
+            mean = total / len(group)
+            result = np.ones(len(E), dtype=bool)
+            for g in group:
+                result &= np.abs(E[:, g - 1] - mean) / mean <= delta
+            return result
+        if kind == 'spacing':
+            _, i, j, lo, hi = atom
+            bars = T[:, j - 1] - T[:, i - 1]
+            result = np.ones(len(T), dtype=bool)
+            if lo is not None:
+                result &= bars >= lo
+            if hi is not None:
+                result &= bars <= hi
+            return result
+        raise ValueError('unknown atom: %r' % (atom,))
+
+
+def compile_patterns(specs):
+    """
+    把一組PatternSpec編譯成CompiledPatterns
+    :param specs: array of PatternSpec
+    :return: CompiledPatterns
+    """
+    return CompiledPatterns(specs)
@@ -5,92 +5,174 @@ Ref: https://en.wikipedia.org/wiki/Ramer%E2%80%93Douglas%E2%80%93Peucker_algorit
 尋找歷史股價的趨勢線
 """
 from __future__ import print_function
-import matplotlib.pyplot as plt
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg
-from math import *
-
-
-class Point(object):
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
-
-
-class Line(object):
-    def __init__(self, a, b):
-        self.m = (a.y - b.y) / (a.x - b.x)
-        self.k = a.y - self.m * a.x
-
-    def dist(self, p):
-        return abs(self.m * p.x - p.y + self.k) / sqrt(self.m ** 2 + 1)
-
-"""
-TODO: 改成function interface可能比較清楚一些
-
-- 讓user自己控制X的範圍, 可以是簡單的close序列, 也可以是自己scale
-- 支援numpy array
-
-lines = rdp(X, epsilon)
-plot_rdp(X, lines, filename)
-
-"""
+import numpy as np
+from math import sqrt
+from pp import kdata, memo, metrics, downsample
+
+# rdp_significance的計算結果, 以序列內容為key
+significance_memo = memo.LRUMemo(64)
+# rdp_auto看過(但是還沒有建立significance)的序列
+seen_memo = memo.LRUMemo(256)
+
+
+def rdp(X, epsilon):
+    """
+    Ramer-Douglas-Peucker, 回傳保留下來的點(趨勢線的端點)的index.
+
+    當線段上每個點距離這條線都小於epsilon時, 則認為這一條線就是趨勢線. 否則以距離最大的點為分隔點,
+    分成左右兩段繼續往下找. 用stack取代遞迴, 每一段的距離以numpy一次算完 (只取X的view, 不複製)
+    :param X: array of price. 點的座標是(index, X[index]), 可以是close序列, 也可以是自己scale過的序列
+    :param epsilon: 距離的容忍範圍
+    :return: int array of index (遞增)
+    """
+    X = np.asarray(X, dtype=float)
+    n = len(X)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return np.flatnonzero(keep)
+    keep[0] = keep[-1] = True
+    offsets = np.arange(n, dtype=float)
+    stack = [(0, n - 1)]
+    while stack:
+        lo, hi = stack.pop()
+        if hi - lo < 2:
+            continue
+        # 點(lo + i, X[lo + i])到(lo, X[lo])-(hi, X[hi])這條線的距離
+        m = (X[hi] - X[lo]) / (hi - lo)
+        dist = np.abs(m * offsets[1:hi - lo] - (X[lo + 1:hi] - X[lo]))
+        i = dist.argmax()
+        if dist[i] / sqrt(m ** 2 + 1) > epsilon:
+            mid = lo + 1 + i
+            keep[mid] = True
+            stack.append((mid, hi))
+            stack.append((lo, mid))
+    return np.flatnonzero(keep)
+
+
+def rdp_significance(X):
+    """
+    把RDP的分割過程一次做到底, 紀錄每一個點在哪一個epsilon以下會被保留.
+
+    每一段的分隔點記錄當時的最大距離, 但是一個點必須在它所有上層的分隔點都成立時才會出現,
+    所以取min(自己的距離, 上層的significance). 頭尾兩點永遠保留(inf).
+    結果與rdp()的關係: rdp(X, eps) == np.flatnonzero(rdp_significance(X) > eps)
+    :param X: array of price
+    :return: float array, 長度與X相同 (唯讀, 同樣內容的序列會共用快取的結果)
+    """
+    X = np.asarray(X, dtype=float)
+    return significance_memo.get(memo.fingerprint(X), lambda: _rdp_significance(X))
+
+
+def _rdp_significance(X):
+    n = len(X)
+    significance = np.zeros(n)
+    if n > 0:
+        significance[0] = significance[-1] = np.inf
+    offsets = np.arange(n, dtype=float)
+    stack = [(0, n - 1, np.inf)]
+    while stack:
+        lo, hi, bound = stack.pop()
+        if hi - lo < 2:
+            continue
+        m = (X[hi] - X[lo]) / (hi - lo)
+        dist = np.abs(m * offsets[1:hi - lo] - (X[lo + 1:hi] - X[lo]))
+        i = dist.argmax()
+        mid = lo + 1 + i
+        significance[mid] = min(dist[i] / sqrt(m ** 2 + 1), bound)
+        stack.append((mid, hi, significance[mid]))
+        stack.append((lo, mid, significance[mid]))
+    significance.flags.writeable = False
+    return significance
+
+
+def rdp_auto(X, epsilon):
+    """
+    與rdp(X, epsilon)的結果相同. rdp_significance比rdp()慢很多 (每個點都要分割一次),
+    所以第一次遇到的序列直接跑rdp(), 同一個序列再次查詢時才建立rdp_significance (之後換epsilon只需要O(n))
+    :param X: array of price
+    :param epsilon: 距離的容忍範圍
+    :return: int array of index (遞增)
+    """
+    X = np.asarray(X, dtype=float)
+    key = memo.fingerprint(X)
+    if key in significance_memo or key in seen_memo:
+        return select_vertices(rdp_significance(X), epsilon)
+    seen_memo.get(key, lambda: True)
+    return rdp(X, epsilon)
+
+
+def select_vertices(significance, epsilon=None, top_k=None):
+    """
+    由rdp_significance的結果挑出趨勢線的端點
+    :param significance: rdp_significance(X)
+    :param epsilon: optional. 保留significance > epsilon的點 (等同於rdp(X, epsilon))
+    :param top_k: optional. 只保留significance最大的top_k個點
+    :return: int array of index (遞增)
+    """
+    keep = np.ones(len(significance), dtype=bool)
+    if epsilon is not None:
+        keep &= significance > epsilon
+    if top_k is not None and top_k < keep.sum():
+        candidates = np.flatnonzero(keep)
+        best = np.argpartition(-significance[candidates], top_k - 1)[:top_k] if top_k > 0 else []
+        keep[:] = False
+        keep[candidates[best]] = True
+    return np.flatnonzero(keep)
 
 
 class RDP(object):
-    def __init__(self, klist, epsilon):
+    def __init__(self, klist, epsilon, ranked=False):
+        """
+        :param klist: KData, array of KBlock, 或是close的numpy array
+        :param epsilon: 距離的容忍範圍 (close已經scale到0~100)
+        :param ranked: True的話使用rdp_significance (同一個序列第一次計算之後, 換epsilon只需要O(n)),
+                       'auto'的話使用rdp_auto (同一個序列第二次查詢時才建立significance)
+        """
         self.close = self.getpriceseries(klist)
-        points = [Point(i, self.close[i]) for i in range(len(self.close))]
-        self.lines = self.douglas_peucker(points, epsilon)
-        self.line_x = [self.lines[i].x for i in range(len(self.lines))]
-        self.line_y = [self.lines[i].y for i in range(len(self.lines))]
+        with metrics.timer('rdp'):
+            if ranked == 'auto':
+                self.vertices = rdp_auto(self.close, epsilon)
+            elif ranked:
+                self.vertices = select_vertices(rdp_significance(self.close), epsilon)
+            else:
+                self.vertices = rdp(self.close, epsilon)
+        self.line_x = self.vertices
+        self.line_y = self.close[self.vertices]
 
     def getpriceseries(self, klist):
         # 直接抽取close點
         #
-        # return [node.close for node in klist]
-        max_value = max(node.close for node in klist)
-        min_value = min(node.close for node in klist)
-        scale_base = max(max_value - min_value, 1)
-        return [(node.close - min_value) * 100.0 / scale_base for node in klist]
-
-    def douglas_peucker(self, points, eps):
-        """
-        eps: 當線段上每個點距離這條線都小於eps時, 則認為這一條線就是趨勢線. 否則以距離最大的點為分隔點, 分成左右兩組繼續往下找
-        """
-        if len(points) == 1:
-            return [points[0]]
-        line = Line(points[0], points[-1])
-        _max = 0
-        for i in range(1, len(points) - 1):
-            if line.dist(points[i]) > _max:
-                _max = line.dist(points[i])
-                _furthest = i
-
-        lines = []
-        if _max > eps:
-            lines_left = self.douglas_peucker(points[:_furthest], eps)
-            lines_right = self.douglas_peucker(points[_furthest:], eps)
-            lines.extend(lines_left)
-            lines.extend(lines_right)
-        else:
-            lines.append(points[0])
-            lines.append(points[-1])
-
-        return lines
+        # return kdata.get_close_nparray(klist)
+        close = kdata.get_close_nparray(klist)
+        min_value = close.min()
+        scale_base = max(close.max() - min_value, 1)
+        return (close - min_value) * 100.0 / scale_base
 
     def render(self, ax):
-        ax.plot(range(len(self.close)), self.close, c='b')
+        n_out = downsample.figure_points(ax.figure)
+        if downsample.needed(len(self.close), n_out):
+            # 縮減到大約像素寬度, RDP的頂點一定保留
+            index = downsample.lttb(self.close, n_out, keep=self.vertices)
+            ax.plot(index, self.close[index], c='b')
+        else:
+            ax.plot(range(len(self.close)), self.close, c='b')
         ax.plot(self.line_x, self.line_y, c='r')
 
     def show(self):
+        # matplotlib只有畫圖時才import (import很花時間)
+        import matplotlib.pyplot as plt
         fig = plt.figure(figsize=(12,9))
         ax = fig.add_subplot(111)
         self.render(ax)
         plt.show()
 
-    def render_png(self, pngfile):
-        fig = Figure(figsize=(12,9))
+    def render_png(self, pngfile, width=12, height=9):
+        """
+        :param pngfile: 檔名, 或是file-like object (例如io.BytesIO)
+        """
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=(width, height))
         ax = fig.add_subplot(111)
         self.render(ax)
         canvas = FigureCanvasAgg(fig)
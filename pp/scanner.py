@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+平行掃描多個股號的pattern
+
+K線資料由KDataSvc.getdata_many同時抓取, 再交給process pool計算 (傳給worker的是KData內部的
+numpy array, 而不是array of KBlock). 每個股號的結果一完成就輸出, 單一股號的錯誤不會影響其他股號.
+
+worker process以forkserver (Windows是spawn) 啟動, 所以呼叫scan/scan_panel的script
+要放在 if __name__ == '__main__': 裡面.
+
+命令列:
+    $ python -m pp.scanner --symbols 2330.TW,2317.TW --thresh 0.03,0.05 > result.jsonl
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+from datetime import date, datetime
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from pp import kdata, zigzag
+from pp.panel import Panel
+from pp.patternfinder import Finder
+
+
+def scan_kdata(symbol, kd, thresholds, delta):
+    """
+    掃描一個股號在每一個threshold下的pattern
+    :param symbol: 股號
+    :param kd: KData
+    :param thresholds: array of zigzag threshold
+    :param delta: pattern的誤差容忍值
+    :return: array of dict (每一個threshold一筆), pattern以pivot points的日期表示
+    """
+    return _scan_series(symbol, kd.close, kd.date, thresholds, delta)
+
+
+def _scan_series(symbol, X, dates, thresholds, delta):
+    finder = Finder(X)
+    results = []
+    for thresh in thresholds:
+        finder.init_pivots(thresh)
+        results.append(_finder_result(symbol, thresh, finder, dates, delta))
+    return results
+
+
+def _finder_result(symbol, thresh, finder, dates, delta):
+    patterns = finder.find_all(delta)
+    return {
+        'symbol': symbol,
+        'thresh': thresh,
+        'patterns': dict((name, [dates[p].tolist() for p in found]) for name, found in patterns.items()),
+    }
+
+
+def _scan_job(symbol, data, thresholds, delta):
+    try:
+        return scan_kdata(symbol, kdata.KData(data), thresholds, delta)
+    except Exception as e:
+        return [_error(symbol, e)]
+
+
+def _mp_context():
+    # scan()開始計算時getdata_many的thread已經在抓資料, 這時候fork會把其他thread拿著的lock
+    # (例如logging, http connection pool) 一起複製到worker. 改用forkserver (沒有的話用spawn)
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def _error(symbol, e):
+    return {'symbol': symbol, 'error': '%s: %s' % (type(e).__name__, e)}
+
+
+def scan(svc, symbols, freq, start, end, thresholds, delta=0.005, processes=None):
+    """
+    平行掃描多個股號, 依完成的順序回傳結果
+    :param svc: KDataSvc
+    :param symbols: array of 股號
+    :param freq: K線週期
+    :param start: 起始日期(date)
+    :param end: 結束日期(date)
+    :param thresholds: array of zigzag threshold
+    :param delta: pattern的誤差容忍值
+    :param processes: optional. process數目, 預設是CPU數目
+    :return: generator of dict. 失敗的股號回傳 {'symbol': ..., 'error': ...}
+    """
+    processes = processes or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(processes, mp_context=_mp_context())
+    # 同時在pool裡面等待的工作數量上限, 避免抓資料比計算快的時候佔用太多記憶體
+    max_pending = processes * 4
+    pending = {}
+    try:
+        for symbol, kd, err in svc.getdata_many(symbols, freq, start, end):
+            if err is not None:
+                yield _error(symbol, err)
+                continue
+            pending[pool.submit(_scan_job, symbol, kd.data, thresholds, delta)] = symbol
+            while len(pending) >= max_pending or any(f.done() for f in pending):
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for result in _collect(done, pending):
+                    yield result
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for result in _collect(done, pending):
+                yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+def _collect(done, pending):
+    for future in done:
+        symbol = pending.pop(future)
+        try:
+            results = future.result()
+        except Exception as e:
+            # worker process本身出錯 (例如被kill)
+            results = [_error(symbol, e)]
+        for result in results:
+            yield result
+
+
+# worker process attach的panel (由_attach_panel設定)
+_panel = None
+
+
+def _attach_panel(handle):
+    global _panel
+    _panel = Panel.attach(handle)
+
+
+def _scan_panel_job(first, last, thresholds, delta):
+    # 一次處理panel的[first, last)這幾個row, 每個threshold只呼叫一次peak_valley_pivots_panel
+    symbols = _panel.symbols[first:last]
+    ranges = [_panel.valid_range(symbol) for symbol in symbols]
+    finders = [Finder(_panel.close[first + i, start:end]) for i, (start, end) in enumerate(ranges)]
+    results = dict((symbol, []) for symbol in symbols)
+    errors = {}
+    for thresh in thresholds:
+        _, (rows, index, direction) = zigzag.peak_valley_pivots_panel(_panel.close[first:last], thresh, -thresh)
+        bounds = np.searchsorted(rows, np.arange(len(symbols) + 1))
+        for i, symbol in enumerate(symbols):
+            if symbol in errors:
+                continue
+            try:
+                start, end = ranges[i]
+                finders[i].set_pivot_points(index[bounds[i]:bounds[i+1]] - start, direction[bounds[i]:bounds[i+1]])
+                results[symbol].append(_finder_result(symbol, thresh, finders[i], _panel.dates[start:end], delta))
+            except Exception as e:
+                errors[symbol] = _error(symbol, e)
+    output = []
+    for symbol in symbols:
+        output.extend([errors[symbol]] if symbol in errors else results[symbol])
+    return output
+
+
+def scan_panel(panel, thresholds, delta=0.005, processes=None, chunksize=8):
+    """
+    平行掃描Panel裡面的所有股號. worker以名稱attach同一份panel, 不需要複製價格資料,
+    每個工作的zigzag以peak_valley_pivots_panel一次算完
+    :param panel: Panel
+    :param thresholds: array of zigzag threshold
+    :param delta: pattern的誤差容忍值
+    :param processes: optional. process數目, 預設是CPU數目
+    :param chunksize: 每個工作包含幾個股號
+    :return: generator of dict (格式與scan相同)
+    """
+    pool = ProcessPoolExecutor(processes, mp_context=_mp_context(), initializer=_attach_panel,
+                               initargs=(panel.handle,))
+    symbols = panel.symbols
+    pending = {}
+    try:
+        for i in range(0, len(symbols), chunksize):
+            last = min(i + chunksize, len(symbols))
+            pending[pool.submit(_scan_panel_job, i, last, thresholds, delta)] = ','.join(symbols[i:last])
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for result in _collect(done, pending):
+                yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+def _parse_date(dt):
+    return datetime.strptime(dt, "%Y%m%d").date()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Scan price patterns of many symbols in parallel')
+    parser.add_argument('--server', default=os.getenv('JDDB_HOST', '203.67.19.12'), help='JDDBXML server')
+    parser.add_argument('--symbols', default='', help='comma separated symbols')
+    parser.add_argument('--symbols-file', help='file with one symbol per line')
+    parser.add_argument('--freq', type=int, default=8)
+    parser.add_argument('--start', type=_parse_date, help='yyyymmdd, default: 2 years ago')
+    parser.add_argument('--end', type=_parse_date, help='yyyymmdd, default: today')
+    parser.add_argument('--thresh', default='0.03', help='comma separated zigzag thresholds')
+    parser.add_argument('--delta', type=float, default=0.005)
+    parser.add_argument('--processes', type=int, help='default: number of CPUs')
+    parser.add_argument('--fetch-workers', type=int, default=8)
+    parser.add_argument('--cache', help='KDataCache folder')
+    args = parser.parse_args(argv)
+
+    symbols = [s.strip() for s in args.symbols.split(',') if s.strip()]
+    if args.symbols_file:
+        with open(args.symbols_file) as f:
+            symbols.extend(line.strip() for line in f if line.strip())
+    today = date.today()
+    start = args.start or date(today.year - 2, today.month, today.day)
+    end = args.end or today
+    thresholds = [float(x) for x in args.thresh.split(',')]
+
+    cache = kdata.KDataCache(args.cache) if args.cache else None
+    svc = kdata.KDataSvc(args.server, cache=cache, max_workers=args.fetch_workers)
+    for result in scan(svc, symbols, args.freq, start, end, thresholds, args.delta, args.processes):
+        print(json.dumps(result))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
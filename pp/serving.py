@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+正式環境用的HTTP server (bottle的ServerAdapter)
+
+bottle預設的wsgiref server一次只處理一個request, 一個很慢的getdata或是畫圖就會擋住所有使用者.
+ProductionServer提供兩種worker model:
+- 'threaded': 一個process, 以固定數目的thread處理request. 畫圖(matplotlib)以render_lock保護
+- 'prefork': 先bind socket再fork出多個process, 每個process各自有thread pool, 畫圖可以用到多個core
+
+每個process最多同時接受threads + backlog個request, 超過的直接回傳503.
+收到SIGTERM/SIGINT時停止接受新的連線, 等處理中的request完成後才結束.
+
+    run(app, server=ProductionServer(port=6060, mode='prefork', workers=4, threads=4, backlog=32))
+"""
+from __future__ import print_function
+import os
+import signal
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+from bottle import ServerAdapter
+
+MODES = ('threaded', 'prefork')
+
+# matplotlib的全域狀態(font cache, rcParams...)不是thread-safe, 同一個process裡面一次只畫一張圖
+render_lock = threading.Lock()
+
+_REJECT = (b'HTTP/1.1 503 Service Unavailable\r\n'
+           b'Content-Type: text/plain\r\n'
+           b'Content-Length: 20\r\n'
+           b'Retry-After: 1\r\n'
+           b'Connection: close\r\n'
+           b'\r\n'
+           b'Server is too busy.\n')
+
+
+class _RequestHandler(WSGIRequestHandler):
+    # client太久沒有送完request就放棄, 避免佔住worker thread
+    timeout = 30
+
+    def address_string(self):
+        return self.client_address[0]
+
+    def log_message(self, format, *args):
+        logging.debug('%s - %s', self.client_address[0], format % args)
+
+
+class PooledWSGIServer(WSGIServer):
+    """
+    以固定大小的thread pool處理request的WSGIServer. 等待中的request超過backlog時回傳503
+    """
+    def __init__(self, server_address, handler_class, threads=4, backlog=32):
+        WSGIServer.__init__(self, server_address, handler_class)
+        self.threads = threads
+        self.rejected = 0
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(threads + backlog)
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(False):
+            self.rejected += 1
+            self._reject(request)
+            return
+        if self._pool is None:
+            # fork之後才建立thread pool (prefork的每個process各自一個)
+            self._pool = ThreadPoolExecutor(self.threads)
+        self._pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def _reject(self, request):
+        try:
+            request.sendall(_REJECT)
+        except (OSError, IOError):
+            pass
+        self.shutdown_request(request)
+
+    def drain(self):
+        """
+        等待處理中的request完成
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+
+class ProductionServer(ServerAdapter):
+    """
+    options:
+    - mode: 'threaded' or 'prefork' (預設'threaded')
+    - workers: prefork的process數目 (預設是CPU數目)
+    - threads: 每個process的thread數目 (預設4)
+    - backlog: 每個process最多等待中的request數目 (預設32)
+    """
+    quiet = True
+
+    def run(self, handler):
+        mode = self.options.get('mode', 'threaded')
+        if mode not in MODES:
+            raise ValueError('unknown server mode: %s' % mode)
+        threads = int(self.options.get('threads', 4))
+        backlog = int(self.options.get('backlog', 32))
+        self.srv = make_server(self.host, self.port, handler,
+                               server_class=lambda address, handler_class:
+                               PooledWSGIServer(address, handler_class, threads, backlog),
+                               handler_class=_RequestHandler)
+        self.port = self.srv.server_port
+        if mode == 'threaded':
+            logging.info('serving on %s:%d (threaded, threads=%d)', self.host, self.port, threads)
+            _serve(self.srv)
+        else:
+            workers = int(self.options.get('workers', 0) or os.cpu_count() or 1)
+            logging.info('serving on %s:%d (prefork, workers=%d, threads=%d)', self.host, self.port, workers, threads)
+            self._prefork(workers)
+
+    def _prefork(self, workers):
+        # 所有process一起等同一個socket, 沒搶到連線的accept()不要block住
+        self.srv.socket.setblocking(False)
+        children = set()
+        for _ in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    _serve(self.srv)
+                except BaseException:
+                    logging.exception('worker %d failed', os.getpid())
+                    code = 1
+                finally:
+                    os._exit(code)
+            children.add(pid)
+        self.srv.server_close()
+
+        def forward(signum, frame):
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        signal.signal(signal.SIGTERM, forward)
+        signal.signal(signal.SIGINT, forward)
+        while children:
+            try:
+                pid, _ = os.wait()
+            except ChildProcessError:
+                break
+            children.discard(pid)
+
+
+def _serve(srv):
+    """
+    執行srv.serve_forever(), 收到SIGTERM/SIGINT時graceful shutdown
+    """
+    def stop(signum, frame):
+        # shutdown()會等serve_forever結束, 不能在同一個thread(signal handler)裡面呼叫
+        threading.Thread(target=srv.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        srv.serve_forever()
+    finally:
+        srv.drain()
+        srv.server_close()
+        if srv.rejected:
+            logging.info('rejected %d requests (server busy)', srv.rejected)
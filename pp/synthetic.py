@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+產生可重現(seeded)的模擬K線資料, 給benchmark以及離線測試使用.
+
+價格是幾何布朗運動(GBM), 並且會在幾種市場狀態(regime)之間切換 (例如多頭/盤整/空頭/高波動),
+每個regime有自己的drift與volatility, 持續的K棒數目是幾何分配.
+
+    kd = synthetic.make_kdata(100000, seed=1)
+    universe = synthetic.make_universe(2000, 5000, seed=1)     # dict of symbol => KData
+    payload = synthetic.to_jddbxml(kd)                          # gethistdata.aspx格式的回傳內容
+"""
+import numpy as np
+from pp import kdata
+
+# (每根K棒的drift, 每根K棒的volatility)
+REGIMES = (
+    (0.0008, 0.012),    # 多頭
+    (0.0, 0.008),       # 盤整
+    (-0.0010, 0.018),   # 空頭
+    (0.0, 0.035),       # 高波動
+)
+
+
+def business_dates(n, start='2000-01-03'):
+    """
+    從start開始的n個工作天 (週一到週五)
+    :return: int32 array of yyyymmdd
+    """
+    days = np.busday_offset(np.datetime64(start, 'D'), np.arange(n), roll='forward')
+    months = days.astype('M8[M]')
+    year = months.astype('M8[Y]').astype(np.int64) + 1970
+    month = months.astype(np.int64) % 12 + 1
+    day = (days - months.astype('M8[D]')).astype(np.int64) + 1
+    return (year * 10000 + month * 100 + day).astype(np.int32)
+
+
+def make_kdata(n, seed=0, start_price=100.0, mean_duration=120, regimes=REGIMES, max_ratio=20, start='2000-01-03'):
+    """
+    產生n根K棒
+    :param n: K棒數目
+    :param seed: random seed, 相同的參數與seed產生相同的資料
+    :param start_price: 第一根K棒的開盤價
+    :param mean_duration: 每個regime平均持續的K棒數目
+    :param regimes: array of (drift, volatility)
+    :param max_ratio: 價格大約維持在start_price的1/max_ratio到max_ratio倍之間
+    :param start: 第一根K棒的日期
+    :return: KData
+    """
+    rs = np.random.RandomState(seed)
+    log_returns = np.empty(n)
+    vol = np.empty(n)
+    level = 0.0
+    pos = 0
+    while pos < n:
+        length = min(rs.geometric(1.0 / mean_duration), n - pos)
+        mu, sigma = regimes[rs.randint(len(regimes))]
+        # GBM: log return = (mu - sigma^2 / 2) + sigma * Z
+        drift = mu - sigma * sigma / 2
+        # 價格離起始價太遠(超過max_ratio倍)時, drift往回拉, 避免很長的序列跑到0或是無限大
+        if level > np.log(max_ratio):
+            drift = -abs(drift) - 0.0005
+        elif level < -np.log(max_ratio):
+            drift = abs(drift) + 0.0005
+        log_returns[pos:pos + length] = drift + sigma * rs.standard_normal(length)
+        vol[pos:pos + length] = sigma
+        level += log_returns[pos:pos + length].sum()
+        pos += length
+    close = start_price * np.exp(np.cumsum(log_returns))
+    prev_close = np.concatenate([[start_price], close[:-1]])
+    open_ = prev_close * np.exp(vol * 0.3 * rs.standard_normal(n))
+    high = np.maximum(open_, close) * (1 + np.abs(rs.standard_normal(n)) * vol * 0.5)
+    low = np.minimum(open_, close) * (1 - np.minimum(np.abs(rs.standard_normal(n)) * vol * 0.5, 0.5))
+    volume = np.round(rs.lognormal(10, 1, n) * (1 + vol * 20))
+    return kdata.KData.from_columns(business_dates(n, start), np.round(open_, 2), np.round(high, 2),
+                                    np.round(low, 2), np.round(close, 2), volume)
+
+
+def make_universe(symbols, n, seed=0, ragged=True):
+    """
+    產生多個股號的K線資料
+    :param symbols: 股號數目, 或是array of 股號
+    :param n: 每個股號最多的K棒數目
+    :param seed: random seed
+    :param ragged: True的話每個股號的上市日期不同 (資料長度不同, 結束日期相同)
+    :return: dict of symbol => KData
+    """
+    if isinstance(symbols, int):
+        symbols = ['S%04d' % i for i in range(symbols)]
+    rs = np.random.RandomState(seed)
+    dates = business_dates(n)
+    universe = {}
+    for i, symbol in enumerate(symbols):
+        length = rs.randint(max(n // 4, 1), n + 1) if ragged else n
+        kd = make_kdata(length, seed=seed * 100003 + i, start_price=rs.uniform(10, 500))
+        kd.data['date'] = dates[n - length:]
+        universe[symbol] = kd
+    return universe
+
+
+def to_jddbxml(kd):
+    """
+    把KData轉成JDDBXML gethistdata.aspx的回傳內容 (資料由新到舊)
+    :param kd: KData
+    :return: bytes
+    """
+    rows = ['<item d="%d" o="%.2f" h="%.2f" l="%.2f" c="%.2f" v="%d"/>' % tuple(x)
+            for x in kd.data[::-1].tolist()]
+    return ('<?xml version="1.0" encoding="utf-8"?>\n<root><data>\n' + '\n'.join(rows) +
+            '\n</data></root>\n').encode('utf-8')
@@ -8,27 +8,55 @@ Ref:
 """
 from __future__ import print_function
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg
+from pp import kdata, memo, metrics, downsample
 
 PEAK, VALLEY = 1, -1
 
+# peak_valley_pivots的快取, key是(序列的fingerprint, up_thresh, down_thresh).
+# pivot_memo.info()可以看到hits/misses
+pivot_memo = memo.LRUMemo(256)
+
+# 序列數量達到這個值時, peak_valley_pivots_panel才比逐一呼叫peak_valley_pivots快
+# (長度1500~5000的序列大約在100~200個以上), 少於這個數量時逐一計算, 也會用到pivot_memo
+PANEL_MIN_ROWS = 128
+
+
+def _as_series(X):
+    """KData直接取close欄位(view), 其他則原封不動"""
+    if isinstance(X, kdata.KData):
+        return X.close
+    return X
+
 
 def plot_zigzag(X, pivots, width=8, height=6, filename=''):
+    """
+    畫出X與zigzag線. filename可以是檔名或是file-like object (例如io.BytesIO), 沒有傳的話直接顯示
+    """
+    # matplotlib只有畫圖時才import (import很花時間)
+    from matplotlib.figure import Figure
+    X = _as_series(X)
     size = (width, height)
     if filename:
         fig = Figure(figsize=size)
     else:
+        import matplotlib.pyplot as plt
         fig = plt.figure(figsize=size)
     ax = fig.add_subplot(111)
     ax.set_xlim(-10, len(X)+10)
     ax.set_ylim(X.min()*0.99, X.max()*1.01)
-    ax.plot(np.arange(len(X)), X, 'k:', alpha=0.7)
-    ax.plot(np.arange(len(X))[pivots != 0], X[pivots != 0], 'k-')
+    pv_index = np.flatnonzero(pivots)
+    n_out = downsample.figure_points(fig)
+    if downsample.needed(len(X), n_out):
+        # 縮減到大約像素寬度, pivots一定保留
+        index = downsample.lttb(X, n_out, keep=pv_index)
+        ax.plot(index, X[index], 'k:', alpha=0.7)
+    else:
+        ax.plot(np.arange(len(X)), X, 'k:', alpha=0.7)
+    ax.plot(pv_index, X[pv_index], 'k-')
     ax.scatter(np.arange(len(X))[pivots == 1], X[pivots == 1], color='g')
     ax.scatter(np.arange(len(X))[pivots == -1], X[pivots == -1], color='r')
     if filename:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
         canvas = FigureCanvasAgg(fig)
         canvas.print_png(filename)
     else:
@@ -72,7 +100,7 @@ def peak_valley_pivots(X, up_thresh, down_thresh):
 
     Parameters
     ----------
-    X : This is your series.
+    X : This is your series (or a KData, in which case the close column is used).
     up_thresh : The minimum relative change necessary to define a peak.
     down_thesh : The minimum relative change necessary to define a valley.
 
@@ -94,10 +122,26 @@ def peak_valley_pivots(X, up_thresh, down_thresh):
     changes. This is a tradeoff between technical correctness and the
     propensity to make mistakes in data analysis. The possible mistake is
     ignoring data outside the fully realized segments, which may bias analysis.
+
+    Caching
+    -------
+    Results are memoized in pivot_memo by the content of X and the thresholds,
+    so the returned array is shared and read-only; copy it before modifying.
     """
     if down_thresh > 0:
         raise ValueError('The down_thresh must be negative.')
 
+    X = _as_series(X)
+    key = (memo.fingerprint(X), up_thresh, down_thresh)
+
+    def compute():
+        # 只量測實際的計算 (命中快取的次數看pivot_memo.info())
+        with metrics.timer('zigzag'):
+            return _peak_valley_pivots(X, up_thresh, down_thresh)
+    return pivot_memo.get(key, compute)
+
+
+def _peak_valley_pivots(X, up_thresh, down_thresh):
     initial_pivot = _identify_initial_pivot(X, up_thresh, down_thresh)
 
     t_n = len(X)
@@ -142,11 +186,388 @@ def peak_valley_pivots(X, up_thresh, down_thresh):
     elif pivots[t_n-1] == 0:
         pivots[t_n-1] = -trend
 
+    pivots.flags.writeable = False
     return pivots
 
 
+def peak_valley_pivots_panel(X, up_thresh, down_thresh):
+    """
+    Finds the peaks and valleys of every row of a 2-D array in one call.
+
+    All rows advance in lockstep: each step over the bar axis updates the
+    state of every row with vectorized operations, so the Python loop runs
+    once per bar instead of once per bar per symbol.
+
+    Parameters
+    ----------
+    X : 2-D array (symbols x bars). Each row is treated as the series
+        between its first and last non-NaN value; NaNs inside that range
+        are skipped, exactly as peak_valley_pivots skips them.
+    up_thresh : The minimum relative change necessary to define a peak.
+    down_thesh : The minimum relative change necessary to define a valley.
+
+    Returns
+    -------
+    (pivots, (rows, index, direction)): the 2-D int8 pivots array, where each
+    row equals peak_valley_pivots of that row's valid range, and the same
+    pivots as a sparse list of row, bar index and PEAK/VALLEY arrays.
+    """
+    if down_thresh > 0:
+        raise ValueError('The down_thresh must be negative.')
+
+    X = np.asarray(X)
+    n_rows, t_n = X.shape
+    if n_rows == 0 or t_n == 0:
+        empty = np.zeros(0, dtype=np.intp)
+        return np.zeros(X.shape, dtype='i1'), (empty, empty.copy(), np.zeros(0, dtype='i1'))
+    rows = np.arange(n_rows)
+    valid = ~np.isnan(X)
+    has_data = valid.any(axis=1)
+    start = np.where(has_data, valid.argmax(axis=1), 0)
+    end = np.where(has_data, t_n - valid[:, ::-1].argmax(axis=1), 0)
+    up_thresh += 1
+    down_thresh += 1
+
+    # Same tests, in the same order, as _identify_initial_pivot.
+    x_0 = X[rows, start]
+    max_x, max_t = x_0.copy(), start.copy()
+    min_x, min_t = x_0.copy(), start.copy()
+    initial = np.zeros(n_rows, dtype='i1')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for t in range(1, t_n):
+            active = (initial == 0) & (t > start) & (t < end)
+            if not active.any():
+                if not ((initial == 0) & (t < end)).any():
+                    break
+                continue
+            x_t = X[:, t]
+            up = active & (x_t / min_x >= up_thresh)
+            initial[up] = np.where(min_t[up] == start[up], VALLEY, PEAK)
+            active &= ~up
+            down = active & (x_t / max_x <= down_thresh)
+            initial[down] = np.where(max_t[down] == start[down], PEAK, VALLEY)
+            active &= ~down
+            new_max = active & (x_t > max_x)
+            max_x[new_max], max_t[new_max] = x_t[new_max], t
+            new_min = active & (x_t < min_x)
+            min_x[new_min], min_t[new_min] = x_t[new_min], t
+        undecided = initial == 0
+        x_last = X[rows, np.maximum(end - 1, 0)]
+        initial[undecided] = np.where(x_0[undecided] < x_last[undecided], VALLEY, PEAK)
+
+        pivots = np.zeros((n_rows, t_n), dtype='i1')
+        pivots[rows[has_data], start[has_data]] = initial[has_data]
+        trend = -initial
+        last_pivot_t = start.copy()
+        last_pivot_x = x_0.copy()
+        for t in range(1, t_n):
+            active = (t > start) & (t < end)
+            x = X[:, t]
+            r = x / last_pivot_x
+            falling = trend == -1
+            reverse = active & np.where(falling, r >= up_thresh, r <= down_thresh)
+            extend = active & ~reverse & np.where(falling, x < last_pivot_x, x > last_pivot_x)
+            if reverse.any():
+                pivots[rows[reverse], last_pivot_t[reverse]] = trend[reverse]
+                trend[reverse] = -trend[reverse]
+            move = reverse | extend
+            last_pivot_x[move] = x[move]
+            last_pivot_t[move] = t
+
+    last = end - 1
+    at_last = has_data & (last_pivot_t == last)
+    pivots[rows[at_last], last[at_last]] = trend[at_last]
+    fill = has_data & ~at_last
+    fill[fill] = pivots[rows[fill], last[fill]] == 0
+    pivots[rows[fill], last[fill]] = -trend[fill]
+
+    pv_rows, pv_index = np.nonzero(pivots)
+    return pivots, (pv_rows, pv_index, pivots[pv_rows, pv_index])
+
+
+class ZigZagState(object):
+    """
+    Incremental version of peak_valley_pivots for series that grow one bar
+    at a time.
+
+    The state carries the current trend, the last (tentative) pivot and the
+    confirmed pivots, so each new bar costs O(1) amortized. Bars seen before
+    the first significant move are kept until the initial pivot is known and
+    then replayed once. After any number of bars, pivots() is identical to
+    peak_valley_pivots on the same series.
+
+    update()/extend() return the changes to the pivots array as a list of
+    (index, direction) pairs, where direction 0 means the mark at index was
+    removed: a pivot confirmed, the tentative end point moved or a new end
+    point added.
+    """
+
+    def __init__(self, up_thresh, down_thresh):
+        if down_thresh > 0:
+            raise ValueError('The down_thresh must be negative.')
+        self.up_thresh = up_thresh
+        self.down_thresh = down_thresh
+        # Same +1 trick as in peak_valley_pivots.
+        self._up = up_thresh + 1
+        self._down = down_thresh + 1
+        self.n = 0
+        self.initial = None
+        self._confirmed = {}
+        self._pending = []
+        self._x0 = None
+        self._p0 = 0
+        self._trend = 0
+        self._last_t = 0
+        self._last_x = None
+        # running max/min while the initial pivot is unknown
+        self._max_x = self._min_x = None
+        self._max_t = self._min_t = 0
+
+    def update(self, x):
+        """Append one bar (its close) and return the pivot changes."""
+        old = {}
+        for k in (0, self.n - 1):
+            if k >= 0:
+                old[k] = self._value(k)
+        confirmed = []
+        t = self.n
+        self.n += 1
+        if t == 0:
+            self._x0 = self._max_x = self._min_x = x
+            self._pending.append(x)
+            self._prefix_state(x)
+        elif self.initial is None:
+            self._pending.append(x)
+            initial = self._check_initial(t, x)
+            if initial is None:
+                self._prefix_state(x)
+            else:
+                self._start(initial, confirmed)
+        else:
+            self._step(t, x, confirmed)
+
+        events = []
+        for k in sorted(set(old) | set(confirmed) | set([self.n - 1])):
+            d = self._value(k)
+            if d != old.get(k, 0):
+                events.append((k, d))
+        return events
+
+    def extend(self, X):
+        """Append a sequence of bars and return the pivot changes."""
+        events = []
+        for x in _as_series(X):
+            events.extend(self.update(x))
+        return events
+
+    def pivots(self):
+        """Return the pivots array for the bars seen so far (see peak_valley_pivots)."""
+        pivots = np.zeros(self.n, dtype='i1')
+        if self.n == 0:
+            return pivots
+        pivots[0] = self._p0
+        for t, d in self._confirmed.items():
+            pivots[t] = d
+        if self._last_t == self.n - 1:
+            pivots[self._last_t] = self._trend
+        elif pivots[self.n - 1] == 0:
+            pivots[self.n - 1] = -self._trend
+        return pivots
+
+    def _value(self, k):
+        if k == self.n - 1 and self._last_t == k:
+            return self._trend
+        if k in self._confirmed:
+            return self._confirmed[k]
+        if k == 0:
+            return self._p0
+        if k == self.n - 1:
+            return -self._trend
+        return 0
+
+    def _check_initial(self, t, x_t):
+        # Same tests, in the same order, as _identify_initial_pivot.
+        if x_t / self._min_x >= self._up:
+            return VALLEY if self._min_t == 0 else PEAK
+        if x_t / self._max_x <= self._down:
+            return PEAK if self._max_t == 0 else VALLEY
+        if x_t > self._max_x:
+            self._max_x = x_t
+            self._max_t = t
+        if x_t < self._min_x:
+            self._min_x = x_t
+            self._min_t = t
+        return None
+
+    def _prefix_state(self, x_last):
+        # No significant move yet: the batch result for the bars so far uses
+        # the fallback initial pivot and never reverses, so the tentative
+        # pivot is simply the running max (up trend) or min (down trend).
+        self._p0 = VALLEY if self._x0 < x_last else PEAK
+        self._trend = -self._p0
+        if self._trend == 1:
+            self._last_t, self._last_x = self._max_t, self._max_x
+        else:
+            self._last_t, self._last_x = self._min_t, self._min_x
+
+    def _start(self, initial, confirmed):
+        self.initial = initial
+        self._p0 = initial
+        self._trend = -initial
+        self._last_t = 0
+        self._last_x = self._x0
+        pending, self._pending = self._pending, None
+        for t in range(1, len(pending)):
+            self._step(t, pending[t], confirmed)
+
+    def _step(self, t, x, confirmed):
+        r = x / self._last_x
+        if self._trend == -1:
+            if r >= self._up:
+                self._confirm(confirmed)
+                self._trend = 1
+                self._last_x = x
+                self._last_t = t
+            elif x < self._last_x:
+                self._last_x = x
+                self._last_t = t
+        else:
+            if r <= self._down:
+                self._confirm(confirmed)
+                self._trend = -1
+                self._last_x = x
+                self._last_t = t
+            elif x > self._last_x:
+                self._last_x = x
+                self._last_t = t
+
+    def _confirm(self, confirmed):
+        self._confirmed[self._last_t] = self._trend
+        if self._last_t == 0:
+            self._p0 = self._trend
+        confirmed.append(self._last_t)
+
+
+class PivotHierarchy(object):
+    """
+    A multi-threshold zigzag built once per series.
+
+    The pivots of peak_valley_pivots(X, min_thresh, -min_thresh) are kept
+    together with the max/min of X strictly between each pair of adjacent
+    pivots. For a coarser threshold the loop of peak_valley_pivots is re-run
+    over the pivot sequence; the bars between two pivots are stepped through
+    only when their max/min could leave a different state than the next
+    pivot alone (a reversal, or a new extreme the next pivot does not pass),
+    otherwise they are skipped. The state after the next pivot is the same
+    either way, so the result equals peak_valley_pivots(X, thresh,
+    -thresh), including the first/last bar rules, while most of X is never
+    visited again.
+    """
+
+    def __init__(self, X, min_thresh=0.01):
+        X = _as_series(X)
+        base = peak_valley_pivots(X, min_thresh, -min_thresh)
+        self.X = X
+        self.n = len(X)
+        self.min_thresh = min_thresh
+        # base pivots: index into X and direction (the first and last bar are always included)
+        self.index = np.flatnonzero(base)
+        self.direction = base[self.index]
+        # gap_max[k], gap_min[k]: max/min of X[index[k]+1:index[k+1]], nan never changes the state
+        values = np.asarray(X, dtype=float)
+        self._values = values.tolist()
+        starts = self.index[:-1] + 1
+        self._gap_max = self._gap_min = []
+        if len(starts):
+            masked = np.where(np.isnan(values), -np.inf, values)
+            masked[self.index] = -np.inf
+            self._gap_max = np.maximum.reduceat(masked, starts).tolist()
+            masked = np.where(np.isnan(values), np.inf, values)
+            masked[self.index] = np.inf
+            self._gap_min = np.minimum.reduceat(masked, starts).tolist()
+
+    def pivot_points(self, thresh):
+        """
+        Return the pivots of peak_valley_pivots(X, thresh, -thresh).
+
+        Returns
+        -------
+        (index, direction): an int array of positions in X and an int8 array
+        of PEAK/VALLEY, in increasing order of index
+        """
+        if thresh < self.min_thresh:
+            raise ValueError('thresh must not be below min_thresh (%s).' % self.min_thresh)
+        if thresh == self.min_thresh:
+            return self.index, self.direction.copy()
+
+        X = self._values
+        index = self.index.tolist()
+        gap_max, gap_min = self._gap_max, self._gap_min
+        initial_pivot = _identify_initial_pivot(X, thresh, -thresh)
+
+        t_n = self.n
+        pivots = {0: initial_pivot}
+        up_thresh = thresh + 1
+        down_thresh = -thresh + 1
+
+        trend = -initial_pivot
+        last_pivot_t = 0
+        last_pivot_x = X[0]
+        for k in range(1, len(index)):
+            # the bars between index[k-1] and index[k] can be skipped if none of them
+            # is a reversal, and any new extreme among them is passed by X[index[k]]
+            lo, hi = gap_min[k-1], gap_max[k-1]
+            if trend == -1:
+                step_in = hi / min(last_pivot_x, lo) >= up_thresh or not (lo >= last_pivot_x or X[index[k]] < lo)
+            else:
+                step_in = lo / max(last_pivot_x, hi) <= down_thresh or not (hi <= last_pivot_x or X[index[k]] > hi)
+            bars = range(index[k-1] + 1, index[k] + 1) if step_in else (index[k],)
+            for t in bars:
+                x = X[t]
+                r = x / last_pivot_x
+
+                if trend == -1:
+                    if r >= up_thresh:
+                        pivots[last_pivot_t] = trend
+                        trend = 1
+                        last_pivot_x = x
+                        last_pivot_t = t
+                    elif x < last_pivot_x:
+                        last_pivot_x = x
+                        last_pivot_t = t
+                else:
+                    if r <= down_thresh:
+                        pivots[last_pivot_t] = trend
+                        trend = -1
+                        last_pivot_x = x
+                        last_pivot_t = t
+                    elif x > last_pivot_x:
+                        last_pivot_x = x
+                        last_pivot_t = t
+
+        if last_pivot_t == t_n-1:
+            pivots[last_pivot_t] = trend
+        elif pivots.get(t_n-1, 0) == 0:
+            pivots[t_n-1] = -trend
+
+        index = np.array(sorted(pivots), dtype=self.index.dtype)
+        direction = np.array([pivots[t] for t in index.tolist()], dtype='i1')
+        return index, direction
+
+    def pivots(self, thresh):
+        """
+        Return the pivots in the format of peak_valley_pivots: 0 for no
+        pivot, PEAK or VALLEY otherwise.
+        """
+        index, direction = self.pivot_points(thresh)
+        pivots = np.zeros(self.n, dtype='i1')
+        pivots[index] = direction
+        return pivots
+
+
 def compute_segment_returns(X, pivots):
     """Return a numpy array of the pivot-to-pivot returns for each segment."""
+    X = _as_series(X)
     pivot_points = X[pivots != 0]
     return pivot_points[1:] / pivot_points[:-1] - 1.0
 
@@ -159,6 +580,7 @@ def max_drawdown(X):
     ----
     If the sequence is strictly increasing, 0 is returned.
     """
+    X = _as_series(X)
     mdd = 0
     peak = X[0]
     for x in X:
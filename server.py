@@ -4,15 +4,62 @@
 
     To run the server:
     $ PORT=6060 python server.py
+
+    To keep a local K-line cache (KDATA_CACHE_MB defaults to 512):
+    $ KDATA_CACHE=/var/cache/pp KDATA_CACHE_MB=512 python server.py
+
+    To use another JDDBXML server (default 203.67.19.12), e.g. bench/fake_jddb.py:
+    $ JDDB_HOST=localhost:7000 python server.py
+
+    Production mode (see pp/serving.py):
+    $ SERVER_MODE=prefork SERVER_WORKERS=4 SERVER_THREADS=4 SERVER_BACKLOG=32 python server.py
+    - SERVER_MODE: threaded (default) or prefork
+    - UPSTREAM_TIMEOUT: timeout (seconds) of the K-line data requests, default 10
+    - HOST: default localhost
+
+    Rendered charts are cached in memory (RENDER_CACHE_MB, default 64) and may be
+    cached by browsers for RENDER_MAX_AGE seconds (default 300).
+
+    Per-stage latency, byte counts and cache hit rates are exported at /metrics (Prometheus
+    text format) and in the Server-Timing response header; METRICS=0 turns them off.
+    In prefork mode each worker keeps its own numbers, so /metrics answers 501 there
+    (Server-Timing still works).
+
+    Development mode (bottle's single-threaded server with debug output):
+    $ DEBUG=1 python server.py
 """
 from __future__ import print_function
-from bottle import route, run, request, response, abort, static_file
+from bottle import route, hook, run, request, response, abort, static_file
 from datetime import datetime, date
 import os
+import io
+import gzip
+import json
+import time
+import hashlib
 import logging
 import traceback
-import tempfile
-from pp import rdp, kdata, zigzag
+import numpy as np
+from pp import rdp, kdata, zigzag, serving, memo, metrics
+from pp.patternfinder import Finder
+
+
+@hook('before_request')
+def begin_request():
+    request.environ['pp.started'] = time.perf_counter()
+    metrics.begin_request()
+
+
+@hook('after_request')
+def end_request():
+    elapsed = time.perf_counter() - request.environ.get('pp.started', time.perf_counter())
+    route = request.environ.get('route.handle')
+    endpoint = route.rule if route is not None else 'unmatched'
+    metrics.request_seconds.observe(elapsed, endpoint)
+    metrics.requests_total.inc(1, endpoint, response.status_code)
+    if metrics.is_enabled():
+        timing = metrics.end_request()
+        response.set_header('Server-Timing', ', '.join([t for t in (timing, 'total;dur=%.1f' % (elapsed * 1000)) if t]))
 
 
 @route('/')
@@ -29,37 +76,193 @@ def server_static(filename):
 def handle_rdp():
     """
     http://<server>/api/rdp?id=2330.TW&start=20100101&end=20151231&eps=5
+
+    optional: w/h = 圖的大小(inch)
     """
     try:
         sid, start_date, end_date, eps = get_param(request)
+        width, height = get_size(request, (12, 9))
+    except ValueError as e:
+        abort(400, str(e))
+    try:
         logging.debug('sid=' + sid + ',start_date=' + str(start_date) + ',end_date=' + str(end_date) + ',eps=' + str(eps))
-        klist = kdatasvc.getdata(sid, 8, start_date, end_date)
-        r = rdp.RDP(klist, eps)
-        png_file = get_temp_file()
-        r.render_png(png_file)
-        return static_file(png_file, root="/", mimetype="image/png")
+
+        def draw(buf):
+            kd = kdatasvc.getdata(sid, 8, start_date, end_date)
+            r = rdp.RDP(kd, eps, ranked='auto')
+            with serving.render_lock, metrics.timer('render'):
+                r.render_png(buf, width, height)
+        return send_png(('rdp', sid, start_date, end_date, eps, (width, height)), draw)
     except Exception as e:
         logging.error(traceback.format_exc())
-        abort(500, e.message)
+        abort(500, str(e))
 
 
 @route('/api/zigzag')
 def handle_zigzag():
     """
     http://<server>/api/zigzag?id=2330.TW&start=20100101&end=20151231&eps=5
+
+    optional: w/h = 圖的大小(inch)
     """
     try:
         sid, start_date, end_date, eps = get_param(request)
+        width, height = get_size(request, (8, 6))
+    except ValueError as e:
+        abort(400, str(e))
+    try:
         logging.debug('sid=' + sid + ',start_date=' + str(start_date) + ',end_date=' + str(end_date) + ',eps=' + str(eps))
-        klist = kdatasvc.getdata(sid, 8, start_date, end_date)
-        X = kdata.get_close_nparray(klist)
-        pivots = zigzag.peak_valley_pivots(X, eps * 0.01, eps * -0.01)
-        png_file = get_temp_file()
-        zigzag.plot_zigzag(X, pivots, filename=png_file)
-        return static_file(png_file, root="/", mimetype="image/png")
+
+        def draw(buf):
+            kd = kdatasvc.getdata(sid, 8, start_date, end_date)
+            pivots = zigzag.peak_valley_pivots(kd, eps * 0.01, eps * -0.01)
+            with serving.render_lock, metrics.timer('render'):
+                zigzag.plot_zigzag(kd, pivots, width, height, filename=buf)
+        return send_png(('zigzag', sid, start_date, end_date, eps, (width, height)), draw)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        abort(500, str(e))
+
+
+@route('/api/analysis')
+def handle_analysis():
+    """
+    http://<server>/api/analysis?id=2330.TW&start=20100101&end=20151231&eps=5&fields=date,close,pivots
+
+    以JSON回傳分析結果, 讓client自己畫圖 (參考web/chart.html). 所有的index都是指date/close的位置
+    optional:
+    - fields: 逗號分隔, 預設是date,close,pivots,rdp,patterns
+      - date/close: K線的日期與收盤價
+      - ohlc: {"open": [...], "high": [...], "low": [...], "close": [...], "volume": [...]}
+      - pivots: zigzag的pivot points, {"index": [...], "dir": [...]} (dir: 1=PEAK, -1=VALLEY)
+      - rdp: RDP的頂點, {"index": [...]}
+      - patterns: Finder.find_all的結果, {pattern name: [[index, ...], ...]}
+    - delta: pattern的誤差容忍值, 預設0.005
+    """
+    try:
+        sid, start_date, end_date, eps = get_param(request)
+        fields = get_fields(request)
+        delta = get_delta(request)
+    except ValueError as e:
+        abort(400, str(e))
+    try:
+        def build():
+            kd = kdatasvc.getdata(sid, 8, start_date, end_date)
+            result = {'id': sid, 'eps': eps}
+            result.update(build_analysis(kd, eps, delta, fields))
+            with metrics.timer('encode'):
+                return make_entry(json.dumps(result, separators=(',', ':')).encode('utf-8'), compress=True)
+        return send_cached(('analysis', sid, start_date, end_date, eps, delta, fields), build, 'application/json')
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        abort(500, str(e))
+
+
+ANALYSIS_FIELDS = ('date', 'close', 'ohlc', 'pivots', 'rdp', 'patterns')
+
+
+def build_analysis(kd, eps, delta, fields):
+    """
+    :param kd: KData
+    :param eps: zigzag的threshold(%) 以及RDP的epsilon
+    :param delta: pattern的誤差容忍值
+    :param fields: 要計算的欄位, ANALYSIS_FIELDS的subset
+    :return: dict
+    """
+    result = {}
+    if 'date' in fields:
+        result['date'] = kd.date.tolist()
+    if 'close' in fields:
+        result['close'] = kd.close.tolist()
+    if 'ohlc' in fields:
+        result['ohlc'] = dict((name, getattr(kd, name).tolist()) for name in ('open', 'high', 'low', 'close', 'volume'))
+    if len(kd) == 0:
+        return result
+    if 'pivots' in fields or 'patterns' in fields:
+        finder = Finder(kd)
+        finder.init_pivots(eps * 0.01)
+        if 'pivots' in fields:
+            result['pivots'] = {'index': finder.pv_index.tolist(), 'dir': finder.pv_dir.tolist()}
+        if 'patterns' in fields:
+            result['patterns'] = finder.find_all(delta)
+    if 'rdp' in fields:
+        result['rdp'] = {'index': rdp.RDP(kd, eps, ranked='auto').vertices.tolist()}
+    return result
+
+
+@route('/api/zigzag/batch')
+def handle_zigzag_batch():
+    """
+    http://<server>/api/zigzag/batch?ids=2330.TW,2317.TW&start=20100101&end=20151231&eps=5
+
+    回傳每個股號的pivot points: {"pivots": {sid: {"date": [...], "dir": [...]}}, "errors": {sid: message}}
+    """
+    try:
+        sids, start_date, end_date, eps = get_batch_param(request)
+    except ValueError as e:
+        abort(400, str(e))
+    try:
+        kds, errors = {}, {}
+        for sid, kd, err in kdatasvc.getdata_many(sids, 8, start_date, end_date):
+            if err is not None:
+                errors[sid] = str(err)
+            else:
+                kds[sid] = kd
+        sids = [sid for sid in sids if sid in kds]
+        pivots = dict((sid, {'date': [], 'dir': []}) for sid in sids)
+        thresh = eps * 0.01
+        if len(sids) < zigzag.PANEL_MIN_ROWS:
+            # 股號不多時逐一計算比較快, 而且會用到pivot_memo
+            for sid in sids:
+                if len(kds[sid]) == 0:
+                    continue
+                result = zigzag.peak_valley_pivots(kds[sid].close, thresh, -thresh)
+                index = np.flatnonzero(result)
+                pivots[sid]['date'] = kds[sid].date[index].astype(int).tolist()
+                pivots[sid]['dir'] = result[index].astype(int).tolist()
+            return {'eps': eps, 'pivots': pivots, 'errors': errors}
+        t_n = max(len(kds[sid]) for sid in sids)
+        if t_n == 0:
+            # 都沒有資料
+            return {'eps': eps, 'pivots': pivots, 'errors': errors}
+        X = np.full((len(sids), t_n), np.nan)
+        for i, sid in enumerate(sids):
+            X[i, :len(kds[sid])] = kds[sid].close
+        with metrics.timer('zigzag'):
+            _, (rows, index, direction) = zigzag.peak_valley_pivots_panel(X, thresh, -thresh)
+        for row, i, d in zip(rows.tolist(), index.tolist(), direction.tolist()):
+            sid = sids[row]
+            pivots[sid]['date'].append(int(kds[sid].date[i]))
+            pivots[sid]['dir'].append(d)
+        return {'eps': eps, 'pivots': pivots, 'errors': errors}
     except Exception as e:
         logging.error(traceback.format_exc())
-        abort(500, e.message)
+        abort(500, str(e))
+
+
+@route('/api/stats')
+def handle_stats():
+    """
+    快取與request合併的統計
+    """
+    return {
+        'fetch_flight': kdatasvc.inflight.info(),
+        'render_flight': render_flight.info(),
+        'render_cache': render_cache.info(),
+        'pivot_memo': zigzag.pivot_memo.info(),
+    }
+
+
+@route('/metrics')
+def handle_metrics():
+    """
+    Prometheus text format的統計 (pp.metrics)
+    """
+    if server_mode == 'prefork' and not debug:
+        # 每個worker各自統計, 由哪個worker回答是隨機的, counter會倒退
+        abort(501, 'metrics are kept per worker process; /metrics is not available with SERVER_MODE=prefork')
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return metrics.render()
 
 
 def get_param(req):
@@ -70,10 +273,52 @@ def get_param(req):
     default_start_date = date(today.year - 2, today.month, today.day)
     start_date = parse_date(req.query.start or '', default_start_date)
     end_date = parse_date(req.query.end or '', today)
-    eps = int(req.query.eps or '5')
+    eps = get_eps(req)
     return sid, start_date, end_date, eps
 
 
+def get_batch_param(req):
+    sids, seen = [], set()
+    for sid in (req.query.ids or '').split(','):
+        sid = sid.strip()
+        # 去掉重複的股號, 保持原本的順序
+        if sid and sid not in seen:
+            seen.add(sid)
+            sids.append(sid)
+    if not sids:
+        raise ValueError('missing ids parameter')
+    today = date.today()
+    default_start_date = date(today.year - 2, today.month, today.day)
+    start_date = parse_date(req.query.start or '', default_start_date)
+    end_date = parse_date(req.query.end or '', today)
+    eps = get_eps(req)
+    return sids, start_date, end_date, eps
+
+
+def get_eps(req):
+    eps = int(req.query.eps or '5')
+    if eps <= 0:
+        raise ValueError('eps must be positive')
+    return eps
+
+
+def get_delta(req):
+    delta = float(req.query.delta or '0.005')
+    if not delta >= 0:
+        raise ValueError('delta must not be negative')
+    return delta
+
+
+def get_fields(req):
+    if not req.query.fields:
+        return ('date', 'close', 'pivots', 'rdp', 'patterns')
+    fields = set(field.strip() for field in req.query.fields.split(',') if field.strip())
+    unknown = fields - set(ANALYSIS_FIELDS)
+    if unknown:
+        raise ValueError('unknown fields: ' + ','.join(sorted(unknown)))
+    return tuple(field for field in ANALYSIS_FIELDS if field in fields)
+
+
 def parse_date(dt, def_value):
     try:
         return datetime.strptime(dt, "%Y%m%d").date()
@@ -81,17 +326,116 @@ def parse_date(dt, def_value):
         return def_value
 
 
-def get_temp_file():
-    tf = tempfile.NamedTemporaryFile()
-    temp_file_name = tf.name
-    tf.close()
-    return temp_file_name
+def get_size(req, default):
+    # 圖的大小限制在1~30 inch
+    width = min(max(float(req.query.w or default[0]), 1), 30)
+    height = min(max(float(req.query.h or default[1]), 1), 30)
+    return width, height
+
+
+def render_png(draw):
+    """
+    把draw(buf)畫的圖存成png
+    :return: cache entry, 參考make_entry
+    """
+    buf = io.BytesIO()
+    draw(buf)
+    return make_entry(buf.getvalue())
+
+
+def make_entry(body, compress=False):
+    """
+    :param body: response的內容(bytes)
+    :param compress: 是否另外準備gzip壓縮過的內容
+    :return: (body, etag, gzip body or None)
+    """
+    return body, '"%s"' % hashlib.sha1(body).hexdigest(), gzip.compress(body) if compress else None
+
+
+def send_cached(key, build, content_type):
+    """
+    回傳key對應的內容 (有快取的話直接使用), 支援If-None-Match (304), client接受gzip時回傳壓縮過的內容
+    :param key: (endpoint, id, start, end, eps, ...)
+    :param build: function() => cache entry (參考make_entry), 沒有快取時呼叫
+    :param content_type: response的Content-Type
+    """
+    # 同樣的內容同時有多個request時只產生一次
+    body, etag, gz = render_cache.get(key, lambda: render_flight.do(key, build))
+    use_gzip = gz is not None and 'gzip' in request.get_header('Accept-Encoding', '')
+    if use_gzip:
+        body, etag = gz, etag[:-1] + '-gzip"'
+    if gz is not None:
+        response.set_header('Vary', 'Accept-Encoding')
+    response.set_header('ETag', etag)
+    response.set_header('Cache-Control', 'public, max-age=%d' % render_max_age)
+    if_none_match = request.get_header('If-None-Match', '')
+    if if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]:
+        response.status = 304
+        return b''
+    if use_gzip:
+        response.set_header('Content-Encoding', 'gzip')
+    response.content_type = content_type
+    metrics.response_bytes.observe(len(body), key[0])
+    return body
+
+
+def send_png(key, draw):
+    """
+    回傳key對應的圖
+    :param key: (endpoint, id, start, end, eps, size)
+    :param draw: function(buf), 沒有快取時呼叫它畫圖
+    """
+    return send_cached(key, lambda: render_png(draw), 'image/png')
+
+
+def getenv(name, default, type=str):
+    """
+    讀取環境變數, 格式不對時直接結束程式 (不要帶著一半的設定啟動)
+    :param type: int/float/str
+    """
+    value = os.getenv(name, '')
+    if value == '':
+        return default
+    try:
+        return type(value)
+    except ValueError:
+        raise SystemExit('server.py: invalid %s=%r (expected %s)' % (name, value, type.__name__))
+
+
+port = getenv('PORT', 6060, int)
+cache_dir = getenv('KDATA_CACHE', '')
+cache = kdata.KDataCache(cache_dir, max_bytes=getenv('KDATA_CACHE_MB', 512, int) * 1024 * 1024) \
+    if cache_dir else None
+kdatasvc = kdata.KDataSvc(getenv('JDDB_HOST', '203.67.19.12'), cache=cache,
+                          timeout=getenv('UPSTREAM_TIMEOUT', 10.0, float))
+static_folder = os.path.join(os.path.dirname(__file__), "web")
+render_max_age = getenv('RENDER_MAX_AGE', 300, int)
+render_cache = memo.BytesLRU(getenv('RENDER_CACHE_MB', 64, int) * 1024 * 1024, ttl=render_max_age,
+                             sizeof=lambda item: len(item[0]) + len(item[2] or b''))
+render_flight = memo.SingleFlight()
+metrics.enable(getenv('METRICS', '1') != '0')
+server_mode = getenv('SERVER_MODE', 'threaded')
+debug = getenv('DEBUG', '0') != '0'
+for _name, _info in (('fetch_flight', kdatasvc.inflight.info), ('render_flight', render_flight.info),
+                     ('render_cache', render_cache.info), ('pivot_memo', zigzag.pivot_memo.info),
+                     ('significance_memo', rdp.significance_memo.info)):
+    metrics.register_cache(_name, _info)
+
+
+def main():
+    host = getenv('HOST', 'localhost')
+    if debug:
+        logging.basicConfig(level=logging.DEBUG)
+        run(host=host, port=port, debug=True)
+        return
+    logging.basicConfig(level=logging.INFO)
+    server = serving.ProductionServer(host=host, port=port,
+                                      mode=server_mode,
+                                      workers=getenv('SERVER_WORKERS', 0, int),
+                                      threads=getenv('SERVER_THREADS', 4, int),
+                                      backlog=getenv('SERVER_BACKLOG', 32, int))
+    run(server=server, quiet=True)
 
-try:
-    port = int(os.getenv('PORT', '6060'))
-    kdatasvc = kdata.KDataSvc("203.67.19.12")
-    static_folder = os.path.join(os.path.dirname(__file__), "web")
-except:
-    port = 6060
 
-run(port=port, debug=True)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+fractal.fractal_points必須與ipy/NFractal.ipynb的find_all_points完全相同 (下面是notebook的實作)
+
+    $ python test/test_fractal.py      (或是 python -m pytest test)
+"""
+from __future__ import print_function
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pp import fractal
+
+
+# ---- ipy/NFractal.ipynb ----
+
+def is_low(X, cur, dist):
+    if cur < dist or cur >= len(X) - dist:
+        return False
+    left_all = all(X[cur] < X[i] for i in range(cur-dist, cur))
+    right_all = all(X[cur] < X[i] for i in range(cur+1, cur+1+dist))
+    return left_all and right_all
+
+
+def is_high(X, cur, dist):
+    if cur < dist or cur >= len(X) - dist:
+        return False
+    left_all = all(X[cur] > X[i] for i in range(cur-dist, cur))
+    right_all = all(X[cur] > X[i] for i in range(cur+1, cur+1+dist))
+    return left_all and right_all
+
+
+def find_high(X, cur, dist):
+    while cur < len(X):
+        if is_high(X, cur, dist):
+            return cur
+        cur += 1
+    return -1
+
+
+def find_low(X, cur, dist):
+    while cur < len(X):
+        if is_low(X, cur, dist):
+            return cur
+        cur += 1
+    return -1
+
+
+def find_first_point(X, dist):
+    cur = dist
+    while cur < len(X):
+        if is_high(X, cur, dist):
+            return cur, 1
+        if is_low(X, cur, dist):
+            return cur, -1
+        cur += 1
+    return 0, 0
+
+
+def find_all_points(X, dist):
+    ret = []
+    idx, curr_dir = find_first_point(X, dist)
+    if idx == 0:
+        return ret
+    ret.append((idx, curr_dir))
+    while idx < len(X):
+        if curr_dir == 1:
+            idx = find_low(X, idx+1, dist)
+            if idx < 0:
+                break
+            else:
+                ret.append((idx, -1))
+                curr_dir = -1
+        else:
+            idx = find_high(X, idx+1, dist)
+            if idx < 0:
+                break
+            else:
+                ret.append((idx, 1))
+                curr_dir = 1
+    return ret
+
+
+# ---- tests ----
+
+def points(index, direction):
+    return list(zip(index.tolist(), direction.tolist()))
+
+
+def test_matches_notebook():
+    rs = np.random.RandomState(0)
+    for trial in range(400):
+        n, dist = rs.randint(1, 120), rs.randint(1, 6)
+        # 取整數, 讓相同的價格經常出現 (strict比較)
+        X = np.round(rs.rand(n) * 10)
+        assert points(*fractal.fractal_points(X, dist=dist)) == find_all_points(X, dist), (trial, dist)
+
+
+def test_panel_rows_match_1d():
+    rs = np.random.RandomState(1)
+    for trial in range(60):
+        n_rows, t_n, dist = rs.randint(1, 8), rs.randint(5, 80), rs.randint(1, 4)
+        high = np.full((n_rows, t_n), np.nan)
+        low = high.copy()
+        for i in range(n_rows):
+            m = rs.randint(0, t_n + 1)
+            x = np.round(rs.rand(m) * 10)
+            high[i, t_n - m:] = x + np.round(rs.rand(m) * 3)
+            low[i, t_n - m:] = x - np.round(rs.rand(m) * 3)
+        for alternate in (True, False):
+            rows, index, direction = fractal.fractal_points_panel(high, low, dist, alternate)
+            for i in range(n_rows):
+                valid = ~np.isnan(high[i])
+                expected = fractal.fractal_points(high[i, valid], low[i, valid], dist, alternate)
+                start = np.argmax(valid) if valid.any() else 0
+                mine = rows == i
+                assert np.array_equal(index[mine] - start, expected[0]), (trial, i, alternate)
+                assert np.array_equal(direction[mine], expected[1]), (trial, i, alternate)
+
+
+def test_rolling_max_min():
+    rs = np.random.RandomState(2)
+    for trial in range(100):
+        X = np.round(rs.rand(rs.randint(1, 50)) * 10)
+        window = rs.randint(1, len(X) + 1)
+        starts = range(len(X) - window + 1)
+        assert np.array_equal(fractal.rolling_max(X, window), [X[j:j + window].max() for j in starts])
+        assert np.array_equal(fractal.rolling_min(X, window), [X[j:j + window].min() for j in starts])
+
+
+if __name__ == "__main__":
+    test_matches_notebook()
+    test_panel_rows_match_1d()
+    test_rolling_max_min()
+    print('ok')
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+KDataCache: 以假的fetch確認只向server要求缺少的部分, 以及過期/淘汰/清除的行為
+
+    $ python test/test_kdata_cache.py      (或是 python -m pytest test)
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+from datetime import date
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pp import kdata, synthetic
+
+# 2020-01-01開始的K棒, 涵蓋到今天以後
+MASTER = synthetic.make_kdata(3000, seed=0, start='2020-01-01')
+
+
+class FakeFetch(object):
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, symbol, freq, start, end):
+        self.calls.append((symbol, freq, kdata.date_to_int(start), kdata.date_to_int(end)))
+        return MASTER.slice(start, end)
+
+
+def same(kd, start, end):
+    return np.array_equal(kd.data, MASTER.slice(start, end).data)
+
+
+def with_cache(test, **kwargs):
+    folder = tempfile.mkdtemp()
+    try:
+        test(kdata.KDataCache(folder, **kwargs), FakeFetch(), folder)
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_cold_then_warm():
+    def test(cache, fetch, folder):
+        kd = cache.getdata(fetch, '2330.TW', 'D', date(2021, 1, 1), date(2021, 6, 30))
+        assert same(kd, date(2021, 1, 1), date(2021, 6, 30))
+        assert fetch.calls == [('2330.TW', 'D', 20210101, 20210630)]
+        # 完全在快取範圍內: 不需要fetch
+        kd = cache.getdata(fetch, '2330.TW', 'D', date(2021, 2, 1), date(2021, 3, 31))
+        assert same(kd, date(2021, 2, 1), date(2021, 3, 31))
+        assert len(fetch.calls) == 1
+    with_cache(test)
+
+
+def test_extend_head_and_tail():
+    def test(cache, fetch, folder):
+        cache.getdata(fetch, '2330.TW', 'D', date(2021, 1, 1), date(2021, 6, 30))
+        kd = cache.getdata(fetch, '2330.TW', 'D', date(2020, 6, 1), date(2021, 12, 31))
+        assert same(kd, date(2020, 6, 1), date(2021, 12, 31))
+        # 只要求缺少的頭/尾
+        assert fetch.calls[1:] == [('2330.TW', 'D', 20200601, 20201231), ('2330.TW', 'D', 20210701, 20211231)]
+        kd = cache.getdata(fetch, '2330.TW', 'D', date(2020, 6, 1), date(2021, 12, 31))
+        assert same(kd, date(2020, 6, 1), date(2021, 12, 31))
+        assert len(fetch.calls) == 3
+    with_cache(test)
+
+
+def test_refetch_tail_after_ttl():
+    def test(cache, fetch, folder):
+        today = date.today()
+        cache.getdata(fetch, '2330.TW', 'D', date(2021, 1, 1), today)
+        cache.getdata(fetch, '2330.TW', 'D', date(2021, 1, 1), today)
+        assert len(fetch.calls) == 1
+        # 過了tail_ttl: 上次更新當天以後的K棒重新抓取
+        cache.tail_ttl = 0
+        time.sleep(0.01)
+        kd = cache.getdata(fetch, '2330.TW', 'D', date(2021, 1, 1), today)
+        assert fetch.calls[1] == ('2330.TW', 'D', kdata.date_to_int(today), kdata.date_to_int(today))
+        assert same(kd, date(2021, 1, 1), today)
+    with_cache(test)
+
+
+def test_evict_over_max_bytes():
+    def test(cache, fetch, folder):
+        for i, sid in enumerate(('1101.TW', '2317.TW', '2330.TW')):
+            cache.getdata(fetch, sid, 'D', date(2020, 1, 1), date(2021, 12, 31))
+            # mtime決定淘汰的順序
+            path = os.path.join(folder, sid + '@D.npy')
+            os.utime(path, (1000000 + i, 1000000 + i))
+        size = os.path.getsize(os.path.join(folder, '2330.TW@D.npy'))
+        cache.max_bytes = size * 2
+        cache.getdata(fetch, '2454.TW', 'D', date(2020, 1, 1), date(2021, 12, 31))
+        # 最舊的兩個連同.json/.lock一起刪除
+        assert not [f for f in os.listdir(folder) if f.startswith(('1101.TW', '2317.TW'))]
+        assert sorted(f for f in os.listdir(folder) if not f.endswith('.lock')) == \
+            ['2330.TW@D.json', '2330.TW@D.npy', '2454.TW@D.json', '2454.TW@D.npy']
+        assert cache.size() <= cache.max_bytes
+    with_cache(test)
+
+
+def test_invalidate_removes_lock_files():
+    def test(cache, fetch, folder):
+        for sid in ('2317.TW', '2330.TW'):
+            cache.getdata(fetch, sid, 'D', date(2021, 1, 1), date(2021, 6, 30))
+        cache.invalidate('2317.TW')
+        assert not [f for f in os.listdir(folder) if f.startswith('2317.TW')]
+        cache.invalidate()
+        assert os.listdir(folder) == []
+    with_cache(test)
+
+
+if __name__ == "__main__":
+    test_cold_then_warm()
+    test_extend_head_and_tail()
+    test_refetch_tail_after_ttl()
+    test_evict_over_max_bytes()
+    test_invalidate_removes_lock_files()
+    print('ok')
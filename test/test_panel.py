@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Panel: attach之後的資料與原本的KData相同, detach之後也可以unlink
+
+    $ python test/test_panel.py      (或是 python -m pytest test)
+"""
+from __future__ import print_function
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pp import synthetic
+from pp.panel import Panel
+
+KDATAS = {
+    '2330.TW': synthetic.make_kdata(300, seed=1),
+    '2317.TW': synthetic.make_kdata(250, seed=2)[50:],
+    '1101.TW': synthetic.make_kdata(0, seed=3),
+}
+
+
+def check_attach(panel):
+    attached = Panel.attach(panel.handle)
+    for symbol, kd in KDATAS.items():
+        for field in ('close', 'high', 'low'):
+            assert np.array_equal(attached.series(symbol, field), getattr(kd, field)), (symbol, field)
+        start, end = attached.valid_range(symbol)
+        assert np.array_equal(attached.dates[start:end], kd.date), symbol
+    assert not attached.close.flags.writeable
+    attached.detach()
+
+
+def test_shared_memory():
+    for detach_first in (False, True):
+        panel = Panel.create(KDATAS)
+        check_attach(panel)
+        if detach_first:
+            panel.detach()
+        panel.unlink()
+        try:
+            Panel.attach(panel.handle)
+        except FileNotFoundError:
+            continue
+        assert False, 'the shared memory should be gone after unlink'
+
+
+def test_file():
+    folder = tempfile.mkdtemp()
+    try:
+        for detach_first in (False, True):
+            panel = Panel.create(KDATAS, dtype='f8', path=os.path.join(folder, 'panel.bin'))
+            check_attach(panel)
+            if detach_first:
+                panel.detach()
+            panel.unlink()
+            assert not os.path.exists(panel.handle.name)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    test_shared_memory()
+    test_file()
+    print('ok')
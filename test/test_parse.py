@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+kdata.parse_iterparse必須與parse_bs4的結果完全相同 (以synthetic.to_jddbxml產生JDDBXML)
+
+    $ python test/test_parse.py      (或是 python -m pytest test)
+"""
+from __future__ import print_function
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pp import kdata, synthetic
+
+
+def test_iterparse_matches_bs4():
+    # 1024以上會經過buffer放大的路徑
+    for n in (1, 2, 1023, 1024, 1025, 3000):
+        kd = synthetic.make_kdata(n, seed=n)
+        payload = synthetic.to_jddbxml(kd)
+        expected = kdata.parse(payload, 'bs4')
+        result = kdata.parse(payload, 'iterparse')
+        assert result.data.dtype == expected.data.dtype
+        assert np.array_equal(result.data, expected.data), n
+        # 依日期遞增
+        assert np.array_equal(result.date, kd.date), n
+
+
+def test_empty():
+    for payload in (b'<root/>', synthetic.to_jddbxml(synthetic.make_kdata(0))):
+        for parser in ('bs4', 'iterparse'):
+            kd = kdata.parse(payload, parser)
+            assert len(kd) == 0 and kd.data.dtype == kdata.KDATA_DTYPE, (payload, parser)
+
+
+if __name__ == "__main__":
+    test_iterparse_matches_bs4()
+    test_empty()
+    print('ok')
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Finder.find_all (PatternSpec/compile_patterns)必須與原本逐點判斷的_is_*完全相同.
+下面是原本patternfinder.py的_is_*與find_pattern (凍結的copy, 不要修改)
+
+    $ python test/test_patterns.py      (或是 python -m pytest test)
+"""
+from __future__ import print_function
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pp import synthetic
+from pp.patternfinder import Finder
+
+PEAK, VALLEY = 1, -1
+
+
+# ---- 原本的patternfinder.py ----
+
+def _is_close_enough(p1, p2, delta):
+    return abs(p1 - p2) / p2 <= delta
+
+
+def _is_hs(X, pv_points, cur, delta):
+    if cur > len(pv_points) - 5:
+        return False
+    _, direction = pv_points[cur]
+    if direction != PEAK:
+        return False
+    e1, e2, e3, e4, e5 = X[[p[0] for p in pv_points[cur:cur+5]]]
+    if e3 < e1 or e3 < e5:
+        return False
+    e15 = (e1 + e5)/2
+    e24 = (e2 + e4)/2
+    return \
+        _is_close_enough(e1, e15, delta) and \
+        _is_close_enough(e5, e15, delta) and \
+        _is_close_enough(e2, e24, delta) and \
+        _is_close_enough(e4, e24, delta)
+
+
+def _is_ihs(X, pv_points, cur, delta):
+    if cur > len(pv_points) - 5:
+        return False
+    _, direction = pv_points[cur]
+    if direction != VALLEY:
+        return False
+    e1, e2, e3, e4, e5 = X[[p[0] for p in pv_points[cur:cur+5]]]
+    if e3 > e1 or e3 > e5:
+        return False
+    e15 = (e1 + e5)/2
+    e24 = (e2 + e4)/2
+    return \
+        _is_close_enough(e1, e15, delta) and \
+        _is_close_enough(e5, e15, delta) and \
+        _is_close_enough(e2, e24, delta) and \
+        _is_close_enough(e4, e24, delta)
+
+
+def _is_double_bottom(X, pv_points, cur, delta):
+    if cur > len(pv_points) - 5:
+        return False
+    _, direction = pv_points[cur]
+    if direction != PEAK:
+        return False
+    e1, e2, e3, e4, e5 = X[[p[0] for p in pv_points[cur:cur+5]]]
+    if e3 > e1 or e3 > e5:
+        return False
+    e24 = (e2 + e4)/2
+    return \
+        _is_close_enough(e2, e24, delta) and \
+        _is_close_enough(e4, e24, delta)
+
+
+def _is_double_top(X, pv_points, cur, delta):
+    if cur > len(pv_points) - 5:
+        return False
+    _, direction = pv_points[cur]
+    if direction != VALLEY:
+        return False
+    e1, e2, e3, e4, e5 = X[[p[0] for p in pv_points[cur:cur+5]]]
+    if e3 < e1 or e3 < e5:
+        return False
+    e24 = (e2 + e4)/2
+    return \
+        _is_close_enough(e2, e24, delta) and \
+        _is_close_enough(e4, e24, delta)
+
+
+def _is_triple_bottom(X, pv_points, cur, delta):
+    if cur > len(pv_points) - 7:
+        return False
+    _, direction = pv_points[cur]
+    if direction != PEAK:
+        return False
+    e1, e2, e3, e4, e5, e6, e7 = X[[p[0] for p in pv_points[cur:cur+7]]]
+    if e3 > e1 or e3 > e7:
+        return False
+    if e5 > e1 or e5 > e7:
+        return False
+    e246 = (e2 + e4 + e6)/3
+    if not _is_close_enough(e2, e246, delta) or \
+       not _is_close_enough(e4, e246, delta) or \
+       not _is_close_enough(e6, e246, delta):
+        return False
+    e35 = (e3 + e5) / 2
+    if not _is_close_enough(e3, e35, delta) or \
+       not _is_close_enough(e5, e35, delta):
+        return False
+    return True
+
+
+def _is_triple_top(X, pv_points, cur, delta):
+    if cur > len(pv_points) - 7:
+        return False
+    _, direction = pv_points[cur]
+    if direction != VALLEY:
+        return False
+    e1, e2, e3, e4, e5, e6, e7 = X[[p[0] for p in pv_points[cur:cur+7]]]
+    if e3 < e1 or e3 < e7:
+        return False
+    if e5 < e1 or e5 < e7:
+        return False
+    e246 = (e2 + e4 + e6)/3
+    if not _is_close_enough(e2, e246, delta) or \
+       not _is_close_enough(e4, e246, delta) or \
+       not _is_close_enough(e6, e246, delta):
+        return False
+    e35 = (e3 + e5) / 2
+    if not _is_close_enough(e3, e35, delta) or \
+       not _is_close_enough(e5, e35, delta):
+        return False
+    return True
+
+
+def find_pattern(X, pv_points, fncname, count, delta):
+    patterns = []
+    for i in range(len(pv_points)):
+        if fncname(X, pv_points, i, delta):
+            patterns.append([pt[0] for pt in pv_points[i:i+count]])
+    return patterns
+
+
+PREDICATES = {
+    'hs': (_is_hs, 5),
+    'ihs': (_is_ihs, 5),
+    'double_top': (_is_double_top, 5),
+    'double_bottom': (_is_double_bottom, 5),
+    'triple_top': (_is_triple_top, 7),
+    'triple_bottom': (_is_triple_bottom, 7),
+}
+
+
+# ---- tests ----
+
+def test_find_all_matches_predicates():
+    found = dict((name, 0) for name in PREDICATES)
+    for seed in range(30):
+        kd = synthetic.make_kdata(3000, seed=seed)
+        for thresh in (0.01, 0.02, 0.03):
+            finder = Finder(kd)
+            finder.init_pivots(thresh)
+            for delta in (0.005, 0.02, 0.05):
+                result = finder.find_all(delta)
+                for name, (fn, count) in PREDICATES.items():
+                    expected = [[int(i) for i in p] for p in find_pattern(finder.X, finder.pv_points, fn, count, delta)]
+                    assert result[name] == expected, (seed, thresh, delta, name)
+                    assert getattr(finder, 'find_' + name)(delta) == expected, (seed, thresh, delta, name)
+                    found[name] += len(expected)
+    # 確認每一種pattern都真的有被比對到
+    assert all(found.values()), found
+
+
+if __name__ == "__main__":
+    test_find_all_matches_predicates()
+    print('ok')
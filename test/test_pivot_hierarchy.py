@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+PivotHierarchy.pivots(thresh)必須與peak_valley_pivots(X, thresh, -thresh)完全相同
+
+    $ python test/test_pivot_hierarchy.py      (或是 python -m pytest test)
+"""
+from __future__ import print_function
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pp import zigzag, synthetic
+
+
+THRESHOLDS = (0.01, 0.015, 0.02, 0.03, 0.05, 0.08, 0.13)
+
+
+def test_matches_peak_valley_pivots():
+    for seed in range(40):
+        X = synthetic.make_kdata(200 + 97 * seed, seed=seed).close
+        hierarchy = zigzag.PivotHierarchy(X, 0.01)
+        for thresh in THRESHOLDS:
+            expected = zigzag.peak_valley_pivots(X, thresh, -thresh)
+            assert np.array_equal(hierarchy.pivots(thresh), expected), (seed, thresh)
+            index, direction = hierarchy.pivot_points(thresh)
+            assert np.array_equal(index, np.flatnonzero(expected)), (seed, thresh)
+            assert np.array_equal(direction, expected[index]), (seed, thresh)
+
+
+def test_short_and_flat_series():
+    # 整數價格 (經常相等) 以及很短的序列, 第一根/最後一根K棒的規則
+    rs = np.random.RandomState(0)
+    for trial in range(500):
+        X = np.round(rs.uniform(95, 105, rs.randint(1, 60)))
+        hierarchy = zigzag.PivotHierarchy(X, 0.01)
+        for thresh in (0.02, 0.03, 0.05):
+            expected = zigzag.peak_valley_pivots(X, thresh, -thresh)
+            assert np.array_equal(hierarchy.pivots(thresh), expected), (trial, thresh)
+
+
+def test_below_min_thresh():
+    hierarchy = zigzag.PivotHierarchy(synthetic.make_kdata(100, seed=0).close, 0.02)
+    try:
+        hierarchy.pivots(0.01)
+    except ValueError:
+        return
+    assert False, 'thresh below min_thresh should raise ValueError'
+
+
+if __name__ == "__main__":
+    test_matches_peak_valley_pivots()
+    test_short_and_flat_series()
+    test_below_min_thresh()
+    print('ok')
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+rdp(X, eps)必須等於np.flatnonzero(rdp_significance(X) > eps), rdp_auto與select_vertices也要一致
+
+    $ python test/test_rdp_significance.py      (或是 python -m pytest test)
+"""
+from __future__ import print_function
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pp import rdp, synthetic
+
+
+def random_series(rs):
+    n = rs.randint(0, 400)
+    if rs.rand() < 0.5:
+        return synthetic.make_kdata(n, seed=rs.randint(1000)).close
+    # 整數價格: 距離經常相等, 也有水平的線段
+    return np.round(rs.uniform(0, 20, n))
+
+
+def test_rdp_matches_significance():
+    rs = np.random.RandomState(0)
+    for trial in range(200):
+        X = random_series(rs)
+        significance = rdp.rdp_significance(X)
+        for eps in (0, 0.5, 1, 3, 10):
+            expected = rdp.rdp(X, eps)
+            assert np.array_equal(expected, np.flatnonzero(significance > eps)), (trial, eps)
+            assert np.array_equal(expected, rdp.select_vertices(significance, eps)), (trial, eps)
+            # 第一次是rdp(), 之後是rdp_significance
+            assert np.array_equal(expected, rdp.rdp_auto(X, eps)), (trial, eps)
+
+
+def check_top_k(vertices, significance, candidates, top_k):
+    # significance經常相同 (下層的點以上層為上限), 所以只比較選到的significance
+    assert np.all(np.diff(vertices) > 0)
+    assert len(vertices) == min(top_k, len(candidates))
+    assert np.isin(vertices, candidates).all()
+    rest = np.setdiff1d(candidates, vertices)
+    if len(vertices) and len(rest):
+        assert significance[vertices].min() >= significance[rest].max()
+
+
+def test_select_vertices_top_k():
+    rs = np.random.RandomState(1)
+    for trial in range(100):
+        X = synthetic.make_kdata(rs.randint(3, 400), seed=trial).close
+        significance = rdp.rdp_significance(X)
+        for top_k in (0, 2, 5, 20, len(X), len(X) + 5):
+            check_top_k(rdp.select_vertices(significance, top_k=top_k), significance, np.arange(len(X)), top_k)
+            # 與epsilon同時使用: 先過濾epsilon, 再取最大的top_k個
+            check_top_k(rdp.select_vertices(significance, 1, top_k=top_k), significance, rdp.rdp(X, 1), top_k)
+
+
+if __name__ == "__main__":
+    test_rdp_matches_significance()
+    test_select_vertices_top_k()
+    print('ok')
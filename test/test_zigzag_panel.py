@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+peak_valley_pivots_panel的每一個row, 必須等於該row有資料的範圍(第一個到最後一個非nan)的peak_valley_pivots
+
+    $ python test/test_zigzag_panel.py      (或是 python -m pytest test)
+"""
+from __future__ import print_function
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pp import zigzag, synthetic
+
+
+def random_panel(rs):
+    """
+    長度不同的row (前後以nan補齊), 有些row沒有資料, 有些row中間有nan
+    """
+    n_rows, t_n = rs.randint(1, 20), rs.randint(1, 400)
+    X = np.full((n_rows, t_n), np.nan)
+    for i in range(n_rows):
+        if rs.rand() < 0.1:
+            continue
+        a = rs.randint(0, t_n)
+        b = rs.randint(a + 1, t_n + 1)
+        if rs.rand() < 0.7:
+            X[i, a:b] = synthetic.make_kdata(b - a, seed=rs.randint(1000)).close
+        else:
+            X[i, a:b] = np.round(rs.uniform(95, 105, b - a))
+        if b - a > 5 and rs.rand() < 0.3:
+            X[i, a + 1 + rs.randint(b - a - 2)] = np.nan
+    return X
+
+
+def test_rows_match_1d():
+    rs = np.random.RandomState(0)
+    for trial in range(60):
+        X = random_panel(rs)
+        thresh = rs.choice([0.01, 0.03, 0.1])
+        pivots, (rows, index, direction) = zigzag.peak_valley_pivots_panel(X, thresh, -thresh)
+        for i in range(len(X)):
+            valid = np.flatnonzero(~np.isnan(X[i]))
+            if len(valid) == 0:
+                assert not pivots[i].any(), (trial, i)
+                continue
+            a, b = valid[0], valid[-1] + 1
+            expected = zigzag.peak_valley_pivots(X[i, a:b], thresh, -thresh)
+            assert np.array_equal(pivots[i, a:b], expected), (trial, i)
+            assert not pivots[i, :a].any() and not pivots[i, b:].any(), (trial, i)
+        # sparse的結果與2-D pivots一致, 依(row, index)排序
+        assert len(rows) == np.count_nonzero(pivots)
+        assert np.array_equal(pivots[rows, index], direction)
+        assert np.all(np.diff(rows * X.shape[1] + index) > 0)
+
+
+def test_empty_panel():
+    for shape in ((0, 0), (0, 5), (3, 0)):
+        pivots, (rows, index, direction) = zigzag.peak_valley_pivots_panel(np.full(shape, np.nan), 0.03, -0.03)
+        assert pivots.shape == shape
+        assert len(rows) == len(index) == len(direction) == 0
+
+
+if __name__ == "__main__":
+    test_rows_match_1d()
+    test_empty_panel()
+    print('ok')
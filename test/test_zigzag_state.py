@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+ZigZagState必須與peak_valley_pivots完全相同: 每加入一根K棒之後,
+pivots()以及累積update()回傳的變動, 都要等於peak_valley_pivots(到目前為止的序列)
+
+    $ python test/test_zigzag_state.py      (或是 python -m pytest test)
+"""
+from __future__ import print_function
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pp import zigzag, synthetic
+
+THRESHOLDS = (0.005, 0.01, 0.03, 0.05, 0.2)
+
+
+def series(seed):
+    """
+    一半是模擬的K線, 一半是取整數的random walk (有很多相同的價格)
+    """
+    rs = np.random.RandomState(seed)
+    n = rs.randint(1, 300)
+    if seed % 2:
+        return synthetic.make_kdata(n, seed=seed).close
+    return np.round(150 + np.cumsum(rs.normal(0, 1, n)))
+
+
+def check_prefixes(X, thresh):
+    state = zigzag.ZigZagState(thresh, -thresh)
+    applied = np.zeros(0, dtype='i1')
+    for i, x in enumerate(X):
+        events = state.update(x)
+        applied = np.append(applied, np.int8(0))
+        for index, direction in events:
+            applied[index] = direction
+        expected = zigzag.peak_valley_pivots(X[:i + 1], thresh, -thresh)
+        assert np.array_equal(state.pivots(), expected), (thresh, i)
+        assert np.array_equal(applied, expected), (thresh, i, events)
+
+
+def test_every_prefix():
+    for seed in range(120):
+        check_prefixes(series(seed), THRESHOLDS[seed % len(THRESHOLDS)])
+
+
+def test_extend():
+    X = synthetic.make_kdata(20000, seed=7).close
+    state = zigzag.ZigZagState(0.03, -0.03)
+    state.extend(X[:5000])
+    state.extend(X[5000:])
+    assert np.array_equal(state.pivots(), zigzag.peak_valley_pivots(X, 0.03, -0.03))
+
+
+if __name__ == "__main__":
+    test_every_prefix()
+    test_extend()
+    print('ok')